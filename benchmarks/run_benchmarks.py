@@ -0,0 +1,422 @@
+"""Benchmarks of the simulation, loading, detection and rendering steps.
+
+Synthetic data is generated locally from the ``square_setup`` scenarios at
+several scales and kept in ``benchmarks/data``. Results are written as JSON
+to ``benchmarks/results`` and can be compared with a stored baseline:
+
+    python benchmarks/run_benchmarks.py --scales 1 2 4
+    python benchmarks/run_benchmarks.py --save-baseline
+    python benchmarks/run_benchmarks.py --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from importlib import metadata
+from pathlib import Path
+
+import numpy as np
+
+root = Path(__file__).resolve().parents[1]
+# Make sure that the analysis, simulation and script modules are on sys.path
+sys.path.append(str(root / "seba"))
+sys.path.append(str(root / "seba/simulation"))
+sys.path.append(str(root / "scripts"))
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+DATA_DIR = BENCHMARK_DIR / "data"
+RESULTS_DIR = BENCHMARK_DIR / "results"
+BASELINE_FILE = BENCHMARK_DIR / "baseline.json"
+
+PACKAGES = ["numpy", "numba", "finitewave", "cyclops", "pyvista", "vtk", "pandas"]
+
+
+def measure(func, repeat=5, number=1):
+    """Wall time of ``number`` calls of ``func``, ``repeat`` times.
+
+    Returns:
+        dict: Minimum and median time per call in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return {"min": min(times), "median": statistics.median(times), "repeat": repeat}
+
+
+def scenario_data(scale, test=2, t_max=200):
+    """Mesh and voltage map files of a short square scenario, simulated once."""
+    from create_simulations import run_scenario
+
+    name = f"bench_{test}_{scale}_{t_max}".replace(".", "_")
+    scalars_file = DATA_DIR / f"square/scalars{name}.npy"
+    mesh_file = DATA_DIR / f"square/mesh{name}.npy"
+    if not (scalars_file.exists() and mesh_file.exists()):
+        run_scenario(test, path=DATA_DIR, name=name, scale=scale, t_max=t_max)
+    return mesh_file, scalars_file
+
+
+def kernel_model(test, scale, fused, scars=False):
+    """Scenario model with a random initial u, ready for ``kernel_step``.
+
+    With ``scars`` the scars, holes and the temporary block of the scenario
+    are applied to the mesh before the weights and spans are computed.
+    """
+    from create_simulations import AdjustScar, build_scenario
+
+    model, _, matrices = build_scenario(
+        test, path=DATA_DIR, scale=scale, prepaced=False, track=False
+    )
+    if scars:
+        AdjustScar(
+            0,
+            matrices["temp_scars_matrix"],
+            2,
+            matrices["scars_matrix"],
+            matrices["holes_matrix"],
+        ).adjust_mesh(model.cardiac_tissue.mesh)
+        model.cardiac_tissue.add_boundaries()
+    model.fused = fused
+    model.initialize()
+    model.u[:] = np.random.default_rng(0).random(model.u.shape)
+    return model
+
+
+def kernel_step(model):
+    model.run_diffusion_kernel()
+    model.run_ionic_kernel()
+    model.u_new, model.u = model.u, model.u_new
+
+
+def check_kernels(test, scale, n_steps):
+    """Run the separate and the fused kernels from the same state and assert
+    that u and v are identical afterwards."""
+    separate, fused = (
+        kernel_model(test, scale, fused, scars=True) for fused in [False, True]
+    )
+    for _ in range(n_steps):
+        kernel_step(separate)
+        kernel_step(fused)
+    np.testing.assert_array_equal(separate.u, fused.u)
+    np.testing.assert_array_equal(separate.v, fused.v)
+
+
+def bench_kernels(scale, n_steps=100, repeat=5, threads=None):
+    """Separate (diffusion, then ``ionic_kernel_2d``) and fused kernels on a
+    scenario model, for every number of numba threads in ``threads``
+    (default: powers of two up to all threads). Both records time complete
+    steps, diffusion included.
+
+    Before timing, both kernels are checked to give identical results on a
+    mesh with scars, holes and the temporary block (test 4), so the row runs
+    around them are covered as well.
+    """
+    import numba
+
+    n_max = numba.config.NUMBA_NUM_THREADS
+    if threads is None:
+        threads = sorted({2**k for k in range(n_max.bit_length())} | {n_max})
+
+    records = []
+    for n_threads in threads:
+        n_threads = min(n_threads, n_max)
+        numba.set_num_threads(n_threads)
+        check_kernels(4, scale, n_steps)
+        for fused in [False, True]:
+            model = kernel_model(2, scale, fused)
+            kernel_step(model)  # compile
+            timing = measure(
+                lambda: [kernel_step(model) for _ in range(n_steps)], repeat
+            )
+            n_cells = np.count_nonzero(model.cardiac_tissue.mesh == 1)
+            timing["cell_updates_per_s"] = n_cells * n_steps / timing["min"]
+            name = "fused_kernel_2d" if fused else "separate_kernels_2d"
+            records.append(
+                {"name": name, "scale": scale, "threads": n_threads, **timing}
+            )
+    numba.set_num_threads(n_max)
+    return records
+
+
+def bench_active_set(scale, t_max=200):
+    """Full and active-set stepping of a complete scenario run.
+
+    The voltage maps of both runs have to agree within ``10 * active_tol``,
+    the tolerance stated by ``ModifiedAlievPanfilov2D``.
+    """
+    from create_simulations import run_scenario
+    from custom_fw_classes import ModifiedAlievPanfilov2D
+
+    records = []
+    u_maps = []
+    for active_set in [False, True]:
+        name = f"bench_active_{int(active_set)}_{scale}".replace(".", "_")
+        files = []
+
+        def run():
+            files[:] = run_scenario(
+                2, path=DATA_DIR, name=name, scale=scale, t_max=t_max,
+                active_set=active_set,
+            )
+
+        timing = measure(run, repeat=1)
+        records.append(
+            {"name": f"run_scenario[active_set={active_set}]", "scale": scale, **timing}
+        )
+        u_maps.append(np.load(files[0]))
+
+    tolerance = 10 * ModifiedAlievPanfilov2D().active_tol
+    full, active = u_maps
+    records[-1]["max_error"] = float(np.nanmax(np.abs(active - full)))
+    np.testing.assert_allclose(active, full, rtol=0, atol=tolerance)
+    return records
+
+
+def bench_tracker(scale, n_frames=200, repeat=5):
+    """Sampling of a streaming, compact ``VoltageMapTracker``."""
+    from create_simulations import build_scenario
+
+    model, tracker, _ = build_scenario(2, path=DATA_DIR, scale=scale, name="bench_tracker")
+    with tempfile.TemporaryDirectory() as tmp:
+        tracker.path = tmp
+        model.initialize()
+        every = max(1, round(tracker.step / model.dt))
+        first = round(tracker.start / model.dt)
+
+        def sample():
+            for i in range(n_frames):
+                model.step = first + i * every
+                tracker._track()
+            tracker.flush()
+
+        timing = measure(sample, repeat)
+    timing["frames_per_s"] = n_frames / timing["min"]
+    return [{"name": "VoltageMapTracker._track", "scale": scale, **timing}]
+
+
+def bench_loading(scale, repeat=5):
+    """``load_finitewave_mesh``: voltage maps and quad topology of a scenario.
+
+    The in-memory topology cache is cleared before every call, so each call
+    loads like a new analysis process (the topology from the on-disk cache).
+    """
+    from analyze_simulations import load_finitewave_mesh
+    from analysis.methods import topology
+
+    mesh_file, _ = scenario_data(scale)
+    case, map = str(mesh_file.parent), mesh_file.stem
+
+    def load():
+        topology._topologies.clear()
+        return load_finitewave_mesh(case, map)[2]
+
+    timing = measure(load, repeat)
+    n_points, n_frames = load().shape
+    return [
+        {
+            "name": "load_finitewave_mesh",
+            "scale": scale,
+            "points": n_points,
+            "frames": n_frames,
+            **timing,
+        }
+    ]
+
+
+def bench_detection(scale, repeat=3):
+    """``multi_epm`` with pm and epm, and the phase density map of the result.
+
+    Returns:
+        tuple: Records and the pm and epm results (for the slider benchmark).
+    """
+    import cyclops.phasetools as ft
+    from analyze_simulations import parse_finitewave_mesh
+    from analysis.methods.cache import ResultCache
+    from analysis.methods.multi_epm import multi_epm
+    from analyse_simulation import phase_density_map
+
+    mesh_file, _ = scenario_data(scale)
+    case, map = str(mesh_file.parent), mesh_file.stem
+
+    records = []
+    epms = {}
+    for method in ["pm", "epm"]:
+
+        def detect():
+            # an empty cache every time, so nothing is reused between repeats
+            with tempfile.TemporaryDirectory() as tmp:
+                epms[method] = multi_epm(
+                    parse_finitewave_mesh,
+                    case,
+                    [map],
+                    ft.PhaseField.from_signals,
+                    [method],
+                    0.1 * np.pi,
+                    cache=ResultCache(tmp),
+                )[0]
+
+        timing = measure(detect, repeat)
+        records.append({"name": f"multi_epm[{method}]", "scale": scale, **timing})
+
+    epm = epms["epm"]
+    n_points = epm.phasefield.polydata.n_points
+    if len(epm.critical_cycles):
+        timing = measure(lambda: phase_density_map([epm.critical_cycles], n_points))
+        records.append({"name": "phase_density_map", "scale": scale, **timing})
+    return records, [epms["pm"], epms["epm"]]
+
+
+def bench_slider(scale, epms, n_timesteps=20, repeat=3):
+    """``MultiSlider.update_objects`` of a pm/epm comparison, offscreen.
+
+    Prefetching is off, so only the scrubbing itself is timed. ``cold``
+    starts every repeat with an empty frame cache, ``warm`` scrubs through
+    cached frames.
+    """
+    from analysis.visualization.custom_cyclops_classes import EPMMultiSlider
+
+    slider = EPMMultiSlider(epms, off_screen=True, prefetch=0)
+    slider.visible_objects = ["phasefield", "critical_cycles"]
+    n_frames = len(slider.time_axis)
+    timesteps = np.linspace(0, n_frames - 1, n_timesteps).astype(int)
+    slider.update_objects(int(timesteps[0]))  # build the actors
+
+    def scrub():
+        for timestep in timesteps:
+            slider.update_objects(int(timestep))
+
+    def cold():
+        slider.cache.clear()
+        scrub()
+
+    records = []
+    try:
+        # the last cold repeat leaves every frame cached for the warm one
+        for name, func in [("cold", cold), ("warm", scrub)]:
+            timing = measure(func, repeat)
+            timing["frames_per_s"] = n_timesteps / timing["min"]
+            records.append(
+                {"name": f"MultiSlider.update_objects[{name}]", "scale": scale, **timing}
+            )
+    finally:
+        slider.close()
+    return records
+
+
+def run_benchmarks(scales, skip=(), threads=None):
+    records = []
+    for scale in scales:
+        print(f"scale {scale}")
+        if "kernels" not in skip:
+            records += bench_kernels(scale, threads=threads)
+        if "active_set" not in skip:
+            records += bench_active_set(scale)
+        if "tracker" not in skip:
+            records += bench_tracker(scale)
+        if "loading" not in skip:
+            records += bench_loading(scale)
+        if "detection" not in skip:
+            detection, epms = bench_detection(scale)
+            records += detection
+            if "slider" not in skip:
+                records += bench_slider(scale, epms)
+    return records
+
+
+def versions():
+    found = {}
+    for package in PACKAGES:
+        try:
+            found[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            found[package] = None
+    return found
+
+
+def compare(records, baseline, tolerance=0.2):
+    """Print the change of the median times against a baseline.
+
+    Returns:
+        list: Records that are more than ``tolerance`` slower.
+    """
+    reference = {
+        (r["name"], r["scale"], r.get("threads")): r for r in baseline["results"]
+    }
+    regressions = []
+    print(f"{'benchmark':<32} {'scale':>6} {'baseline':>10} {'now':>10} {'ratio':>7}")
+    for record in records:
+        old = reference.get((record["name"], record["scale"], record.get("threads")))
+        if old is None:
+            continue
+        ratio = record["median"] / old["median"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(record)
+            flag = "  slower"
+        elif ratio < 1 - tolerance:
+            flag = "  faster"
+        name = record["name"]
+        if "threads" in record:
+            name = f"{name} ({record['threads']} threads)"
+        print(
+            f"{name:<32} {record['scale']:>6} {old['median']:>10.4g} "
+            f"{record['median']:>10.4g} {ratio:>7.2f}{flag}"
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "--skip",
+        nargs="*",
+        default=[],
+        choices=["kernels", "active_set", "tracker", "loading", "detection", "slider"],
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=None,
+        help="numba thread counts of the kernel benchmarks",
+    )
+    parser.add_argument("--baseline", type=Path, default=None)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    records = run_benchmarks(args.scales, args.skip, args.threads)
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "python": platform.python_version(),
+        },
+        "versions": versions(),
+        "results": records,
+    }
+
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    results_file = RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}.json"
+    results_file.write_text(json.dumps(report, indent=2))
+    print(f"results: {results_file}")
+    if args.save_baseline:
+        BASELINE_FILE.write_text(json.dumps(report, indent=2))
+        print(f"baseline: {BASELINE_FILE}")
+
+    baseline_file = args.baseline or (BASELINE_FILE if not args.save_baseline else None)
+    if baseline_file is not None and Path(baseline_file).exists():
+        regressions = compare(
+            records, json.loads(Path(baseline_file).read_text()), args.tolerance
+        )
+        if regressions:
+            sys.exit(1)
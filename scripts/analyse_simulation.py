@@ -9,60 +9,64 @@ import pandas as pd
 import pyvista as pv
 from cyclops.extended_phasemapping import ExtendedPhaseMapping
 
-data_dir = Path("data/phase_defect")
 
-u_path = data_dir / "u"
-phase_path = data_dir / "phase"
+def phase_density_map(critical_cycles, n_points):
+    """Log of the number of time steps in which every point is part of a
+    critical cycle (0 for points that never are)."""
+    nodes = (
+        pd.concat(critical_cycles)
+        .groupby("time_axis")["nodes"]
+        .apply(lambda nodes: [x for xs in nodes for x in xs])
+    )
 
-# load action potentials and phases
-list_of_phases = []
-list_of_action_potentials = []
+    nodes_per_time_step = nodes.apply(np.unique).to_list()
+    point_ids, count = np.unique(np.concatenate(nodes_per_time_step), return_counts=True)
+    all_points = np.zeros(n_points)
+    all_points[point_ids] = np.log(count)
+    return all_points
 
-step = 4
-start = 0
-stop = len(list(u_path.glob("*.npy")))
-for i in range(start, stop, step):
-    list_of_action_potentials.append(np.load(u_path / f"{i}.npy").ravel())
-    list_of_phases.append(np.load(phase_path / f"{i}.npy").ravel())
 
-phases = np.column_stack(list_of_phases)
-action_potentials = np.column_stack(list_of_action_potentials)
-phases = np.tanh((-1 * phases) % (2 * np.pi) - np.pi) * np.pi
+if __name__ == "__main__":
+    data_dir = Path("data/phase_defect")
 
-# plot phase and action potential of one point
-plt.plot(phases[500], label="phase", marker=".")
-plt.plot(action_potentials[500, :stop], label="normalized action potential")
-plt.xlabel("timesteps")
-plt.legend()
-plt.savefig("paper/figures/ap_phase.svg")
-plt.show()
+    phase_file = data_dir / "phase.npy"
+    trace = np.load(data_dir / "phase_trace.npz")
 
-# create phase field
-nx, ny = np.load(u_path / "0.npy").shape
-polydata = pv.ImageData(dimensions=(nx, ny, 1), spacing=(1, 1, 1)).extract_surface()
-phasefield = ft.PhaseField(polydata, phases)
+    # load phases
+    step = 4
+    start = 0
+    all_phases = np.load(phase_file, mmap_mode="r")
+    stop, nx, ny = all_phases.shape
+    phases = all_phases[start:stop:step]
+    phases = phases.reshape(phases.shape[0], -1).T.astype(float)
+    phases = np.tanh((-1 * phases) % (2 * np.pi) - np.pi) * np.pi
 
-phasefield_filters = [ft.NaNFilter(), ft.PhaseDiffFilter(0.05 * np.pi)]
-cycle_extractors = [ct.extract_face_cycles, ct.extract_boundary_cycles]
-epm = ExtendedPhaseMapping(phasefield, phasefield_filters, cycle_extractors)
-epm.run()
+    # plot phase and action potential of one point
+    point = 500
+    cell = np.unravel_index(point, (nx, ny))
+    k = np.flatnonzero((trace["cells"] == cell).all(axis=1))[0]
+    plt.plot(phases[point], label="phase", marker=".")
+    plt.plot(trace["u"][start:stop:step, k], label="normalized action potential")
+    plt.xlabel("timesteps")
+    plt.legend()
+    plt.savefig("paper/figures/ap_phase.svg")
+    plt.show()
 
-# visualise results
-slider = vt.Slider(epm)
-slider.visible_objects = ["phasefield", "critical_cycles", "noncritical_cycles"]
-slider.show()
+    # create phase field
+    polydata = pv.ImageData(dimensions=(nx, ny, 1), spacing=(1, 1, 1)).extract_surface()
+    phasefield = ft.PhaseField(polydata, phases)
 
-# Create phase density map
-data = [epm.critical_cycles]
-nodes = (
-    pd.concat(data)
-    .groupby("time_axis")["nodes"]
-    .apply(lambda nodes: [x for xs in nodes for x in xs])
-)
+    phasefield_filters = [ft.NaNFilter(), ft.PhaseDiffFilter(0.05 * np.pi)]
+    cycle_extractors = [ct.extract_face_cycles, ct.extract_boundary_cycles]
+    epm = ExtendedPhaseMapping(phasefield, phasefield_filters, cycle_extractors)
+    epm.run()
 
-nodes_per_time_step = nodes.apply(np.unique).to_list()
-point_ids, count = np.unique(np.concatenate(nodes_per_time_step), return_counts=True)
-all_points = np.zeros(nx * ny)
-all_points[point_ids] = np.log(count)
-plt.imshow(all_points.reshape(nx, ny))
-plt.show()
+    # visualise results
+    slider = vt.Slider(epm)
+    slider.visible_objects = ["phasefield", "critical_cycles", "noncritical_cycles"]
+    slider.show()
+
+    # Create phase density map
+    all_points = phase_density_map([epm.critical_cycles], nx * ny)
+    plt.imshow(all_points.reshape(nx, ny))
+    plt.show()
@@ -1,9 +1,17 @@
+import sys
 from pathlib import Path
 
 import finitewave as fw
 import matplotlib.pyplot as plt
 import numpy as np
 
+from phase_conversion import write_video
+
+# Make sure that the simulation classes are on sys.path
+sys.path.append(str(Path(__file__).resolve().parents[1] / "seba/simulation"))
+
+from custom_fw_classes import PhaseMapTracker, open_voltage_map
+
 # number of nodes on the side
 n = 400
 tissue = fw.CardiacTissue2D([n, n])
@@ -14,20 +22,18 @@ stim_sequence = fw.StimSequence()
 stim_sequence.add_stim(fw.StimVoltageCoord2D(70, 1, n // 4, 3 * n // 4, 0, n // 2))
 
 # set up trackers:
+# the phase is computed during the simulation, so u and v are never dumped
 tracker_sequence = fw.TrackerSequence()
-u_tracker = fw.Animation2DTracker()
-u_tracker.variable_name = "u"
-u_tracker.dir_name = "data/phase_defect/u"
-u_tracker.step = 20
-u_tracker.overwrite = True
-tracker_sequence.add_tracker(u_tracker)
-
-v_tracker = fw.Animation2DTracker()
-v_tracker.variable_name = "v"
-v_tracker.dir_name = "data/phase_defect/v"
-v_tracker.step = 20
-v_tracker.overwrite = True
-tracker_sequence.add_tracker(v_tracker)
+phase_tracker = PhaseMapTracker()
+phase_tracker.dir_name = "data/phase_defect"
+phase_tracker.step = 0.2  # every 20 time steps
+phase_tracker.u_ref = 0.4
+phase_tracker.v_ref = 0.1
+phase_tracker.stream = True
+phase_tracker.dtype = np.float32
+# (200, 200) for the phase-space plot, flat point 500 for the AP/phase figure
+phase_tracker.trace_cells = [(200, 200), divmod(500, n)]
+tracker_sequence.add_tracker(phase_tracker)
 
 # create model object and set up parameters:
 fenton_karma = fw.FentonKarma2D()
@@ -45,41 +51,20 @@ fenton_karma.tracker_sequence = tracker_sequence
 # adjust the number of threads if needed
 fenton_karma.run(num_of_theads=15)
 
-# calculate phase:
-output_dir = Path("data/phase_defect/phase")
-u_path = Path(u_tracker.path, u_tracker.dir_name)
-v_path = Path(v_tracker.path, v_tracker.dir_name)
-if not output_dir.is_dir():
-    output_dir.mkdir(parents=True)
-
-
-track_u = []
-track_v = []
-x, y = 200, 200
-
-u_ref = 0.4
-v_ref = 0.1
-timesteps = len(list(u_path.glob("*.npy")))
-for i in range(timesteps):
-    u = np.load(u_path / f"{i}.npy") - u_ref
-    v = np.load(v_path / f"{i}.npy") - v_ref
-    track_u.append(u[x, y].copy())
-    track_v.append(v[x, y].copy())
-    phase = np.arctan2(u, v)
-    phase[tissue.mesh != 1] = np.nan
-    np.save(output_dir / f"{i}.npy", phase)
+phase_tracker.write()
 
 # visually confirm that the orbit in phase space goes around the origin
-plt.plot(track_u, track_v)
+plt.plot(
+    np.array(phase_tracker.trace_u)[:, 0] - phase_tracker.u_ref,
+    np.array(phase_tracker.trace_v)[:, 0] - phase_tracker.v_ref,
+)
 plt.show()
 
 # create video:
-fw.Animation2DBuilder().write(
-    output_dir,
+write_video(
+    open_voltage_map(phase_tracker.file_path),
+    phase_tracker.file_path.with_suffix(".mp4"),
     clim=(-np.pi, np.pi),
-    shape=fenton_karma.cardiac_tissue.mesh.shape,
     cmap="twilight",
-    clear=False,
-    prog_bar=True,
     fps=100,
 )
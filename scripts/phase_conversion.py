@@ -0,0 +1,131 @@
+"""Convert u/v frames written by Animation2DTracker into one stacked phase array.
+
+The create_* scripts compute the phase during the simulation with a
+``PhaseMapTracker`` instead. ``convert_phase`` is kept for existing u/v dumps.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import ffmpeg
+import matplotlib.pyplot as plt
+import numpy as np
+
+
+def load_frames(path, start, stop):
+    return np.stack([np.load(Path(path) / f"{i}.npy") for i in range(start, stop)])
+
+
+def convert_phase(
+    u_path,
+    v_path,
+    output_file,
+    mesh,
+    u_ref=0.4,
+    v_ref=0.1,
+    trace=None,
+    chunk_size=64,
+    n_threads=8,
+    dtype=np.float32,
+    mmap=True,
+):
+    """Compute ``arctan2(u - u_ref, v - v_ref)`` for every frame.
+
+    Frames are read in chunks by a background thread, so the next chunk is
+    loaded while the phase of the current one is computed across a thread
+    pool. The phases are written to a single ``(n_frames, nx, ny)`` array.
+
+    Args:
+        u_path (Path): Directory with the u frames (``0.npy``, ``1.npy``, ...).
+        v_path (Path): Directory with the v frames.
+        output_file (Path): ``.npy`` file for the stacked phases.
+        mesh (np.ndarray): Tissue mesh, phases outside ``mesh == 1`` are NaN.
+        u_ref (float, optional): Reference value of u.
+        v_ref (float, optional): Reference value of v.
+        trace (tuple, optional): ``(x, y)`` of a pixel whose ``u - u_ref`` and
+            ``v - v_ref`` traces are returned, e.g. for a phase-space plot.
+        chunk_size (int, optional): Number of frames per chunk.
+        n_threads (int, optional): Number of threads computing phases.
+        dtype (np.dtype, optional): Storage dtype of the phases.
+        mmap (bool, optional): Write into a memory-mapped file instead of
+            keeping the stack in memory and saving it at the end.
+
+    Returns:
+        tuple: The phase array and the u and v traces (``None`` without
+            ``trace``).
+    """
+    u_path, v_path = Path(u_path), Path(v_path)
+    n_frames = len(list(u_path.glob("*.npy")))
+    shape = (n_frames, *np.load(u_path / "0.npy").shape)
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    if mmap:
+        phase = np.lib.format.open_memmap(output_file, mode="w+", dtype=dtype, shape=shape)
+    else:
+        phase = np.empty(shape, dtype=dtype)
+    outside = mesh != 1
+
+    track_u, track_v = [], []
+
+    def compute(u, v, start, k):
+        out = np.arctan2(u[k] - u_ref, v[k] - v_ref)
+        out[outside] = np.nan
+        phase[start + k] = out
+
+    def load_chunk(start):
+        stop = min(start + chunk_size, n_frames)
+        return start, load_frames(u_path, start, stop), load_frames(v_path, start, stop)
+
+    with ThreadPoolExecutor(1) as prefetcher, ThreadPoolExecutor(n_threads) as pool:
+        future = prefetcher.submit(load_chunk, 0)
+        while future is not None:
+            start, u, v = future.result()
+            next_start = start + chunk_size
+            future = prefetcher.submit(load_chunk, next_start) if next_start < n_frames else None
+
+            if trace is not None:
+                track_u.append(u[:, trace[0], trace[1]] - u_ref)
+                track_v.append(v[:, trace[0], trace[1]] - v_ref)
+            list(pool.map(lambda k: compute(u, v, start, k), range(len(u))))
+
+    if mmap:
+        phase.flush()
+    else:
+        np.save(output_file, phase)
+
+    if trace is None:
+        return phase, None, None
+    return phase, np.concatenate(track_u), np.concatenate(track_v)
+
+
+def write_video(frames, video_file, clim, cmap="twilight", fps=100, nan_color=(0, 0, 0)):
+    """Write a stack of 2D frames to a video by piping RGB frames to ffmpeg.
+
+    Raises:
+        ffmpeg.Error: If ffmpeg fails, with its error output as ``stderr``.
+    """
+    colormap = plt.colormaps[cmap]
+    n_frames, nx, ny = frames.shape
+    # libx264 with yuv420p needs even dimensions
+    height, width = nx + nx % 2, ny + ny % 2
+    process = (
+        ffmpeg.input("pipe:", format="rawvideo", pix_fmt="rgb24", s=f"{width}x{height}", r=fps)
+        .output(str(video_file), vcodec="libx264", pix_fmt="yuv420p")
+        .overwrite_output()
+        # only errors, so the stderr pipe cannot fill up while frames are written
+        .global_args("-loglevel", "error")
+        .run_async(pipe_stdin=True, pipe_stderr=True)
+    )
+    nan_rgb = np.array(nan_color, dtype=np.uint8)
+    try:
+        for frame in frames:
+            values = (np.asarray(frame, dtype=float) - clim[0]) / (clim[1] - clim[0])
+            rgb = np.zeros((height, width, 3), dtype=np.uint8)
+            rgb[:nx, :ny] = (colormap(np.clip(values, 0, 1))[..., :3] * 255).astype(np.uint8)
+            rgb[:nx, :ny][np.isnan(values)] = nan_rgb
+            process.stdin.write(rgb.tobytes())
+    except BrokenPipeError:
+        pass  # ffmpeg exited early, its error is raised below
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        raise ffmpeg.Error("ffmpeg", None, stderr)
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from pathlib import Path
+
+from cyclops.parsetools import parse_utils
+
+
+def callable_name(func):
+    """Stable, importable name of a function or bound method."""
+    owner = getattr(func, "__self__", None)
+    if owner is not None and not isinstance(owner, type(os)):
+        owner = owner if isinstance(owner, type) else type(owner)
+        return f"{owner.__module__}.{owner.__qualname__}.{func.__name__}"
+    return f"{func.__module__}.{func.__qualname__}"
+
+
+def file_fingerprint(paths):
+    """Fingerprint a list of files by path, size and modification time.
+
+    Args:
+        paths (list): Paths of the files a result depends on.
+
+    Returns:
+        list: One ``[path, size, mtime_ns]`` entry per existing file.
+    """
+    fingerprint = []
+    for path in paths:
+        path = Path(path)
+        if path.exists():
+            stat = path.stat()
+            fingerprint.append([str(path.resolve()), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def input_files(parser, case, map):
+    """Files read by ``parser`` for a given case and map.
+
+    Parsers can advertise their inputs through an ``input_files(case, map)``
+    attribute. Otherwise the map is looked up as a case file directly.
+
+    Raises:
+        ValueError: If the inputs cannot be resolved. Caching without them
+            could return stale results after an input changed.
+    """
+    if hasattr(parser, "input_files"):
+        files = list(parser.input_files(case, map))
+    else:
+        try:
+            files = [parse_utils.get_case_file(case, map)]
+        except Exception as e:
+            raise ValueError(
+                f"Cannot resolve the input files of {case}/{map}, give "
+                f"{callable_name(parser)} an input_files(case, map) attribute"
+            ) from e
+    if not any(Path(file).exists() for file in files):
+        raise ValueError(f"No input files of {case}/{map} found: {files}")
+    return files
+
+
+def cache_key(**parts):
+    """Hash arbitrary (json serialisable or repr-able) key parts."""
+    blob = json.dumps(parts, sort_keys=True, default=repr)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class ResultCache:
+    """Content-addressed pickle cache with a disk budget and LRU eviction.
+
+    Entries are stored as ``{root}/{key[:2]}/{key}.pkl``. The modification
+    time of an entry is refreshed on every hit, so evicting the files with
+    the oldest modification time removes the least recently used results.
+    """
+
+    def __init__(self, root=None, max_bytes=20 * 1024**3):
+        """
+        Args:
+            root (str | Path, optional): Cache directory. Defaults to
+                ``pickle/cache`` in the project root.
+            max_bytes (int, optional): Disk budget in bytes. ``None`` disables
+                eviction.
+        """
+        if root is None:
+            root = Path(__file__).parent.parent.parent / "pickle/cache"
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bytes on disk, scanned once and then kept up to date by put/evict
+        self._size = None
+
+    def path(self, key):
+        return self.root / key[:2] / f"{key}.pkl"
+
+    def get(self, key):
+        """Return the cached object for ``key`` or ``None`` on a miss."""
+        filepath = self.path(key)
+        try:
+            with open(filepath, "rb") as f:
+                obj = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(filepath)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return obj
+
+    def put(self, key, obj, evict=True):
+        """Store ``obj`` under ``key`` and enforce the disk budget.
+
+        The pickle is written to a temporary file next to the entry and then
+        renamed into place, so concurrent readers never see a partial entry.
+
+        Args:
+            key (str): Cache key.
+            obj: Picklable object to store.
+            evict (bool, optional): Enforce the disk budget afterwards. Worker
+                processes skip this and leave eviction to the parent.
+        """
+        filepath = self.path(key)
+        os.makedirs(filepath.parent, exist_ok=True)
+        try:
+            old_size = filepath.stat().st_size
+        except FileNotFoundError:
+            old_size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=filepath.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(obj, f)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        if self._size is not None:
+            self._size += filepath.stat().st_size - old_size
+        if evict:
+            self.evict()
+
+    def entries(self):
+        """All cache entries as ``(path, size, mtime)``, oldest first."""
+        entries = []
+        for filepath in self.root.glob("*/*.pkl"):
+            try:
+                stat = filepath.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((filepath, stat.st_size, stat.st_mtime_ns))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size(self):
+        """Bytes on disk, only scanned on the first call."""
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self.entries())
+        return self._size
+
+    def refresh_size(self):
+        """Rescan the size on the next call, e.g. after other processes wrote
+        entries."""
+        self._size = None
+
+    def evict(self):
+        """Remove least recently used entries until the budget is met."""
+        if self.max_bytes is None or self.size() <= self.max_bytes:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for filepath, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                filepath.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+        self._size = total
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+            "bytes": self.size(),
+            "max_bytes": self.max_bytes,
+        }
@@ -1,6 +1,9 @@
-import os
+import copy
 import pickle
 import sys
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
 # Make sure that the project root is on sys.path
@@ -10,6 +13,164 @@ import cyclops.cycletools as ct
 import cyclops.phasetools as ft
 from cyclops.extended_phasemapping import ExtendedPhaseMapping
 
+from analysis.methods.cache import (
+    ResultCache,
+    cache_key,
+    callable_name,
+    file_fingerprint,
+    input_files,
+)
+from analysis.methods.profiling import field_sizes, span
+
+
+# result cache of multi_epm calls without their own cache
+_default_cache = None
+
+
+def default_cache():
+    """Result cache shared by the ``multi_epm`` calls without a ``cache``.
+
+    Its ``stats()`` cover all of those calls, worker processes included.
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResultCache()
+    return _default_cache
+
+
+def method_config(method, th):
+    """Phase field filters and cycle extractors of a detection method."""
+    if method == "pm":
+        phasefield_filters = []
+        cycle_extractors = [ct.extract_face_cycles]
+    elif method == "epm":
+        phasefield_filters = [
+            ft.NaNFilter(),
+            ft.PhaseDiffFilter(th),
+        ]
+        cycle_extractors = [
+            ct.extract_face_cycles,
+            ct.extract_boundary_cycles,
+        ]
+    else:
+        raise ValueError(f"Unknown method {method!r}, expected 'pm' or 'epm'")
+    return phasefield_filters, cycle_extractors
+
+
+def compute_phasefield(
+    parser,
+    case,
+    map,
+    phase_calculator,
+    parser_args,
+    phase_calculator_args,
+    profiler=None,
+):
+    with span(profiler, "parser"):
+        polydata, scalars = parser(case, map, **parser_args)
+    sizes = {
+        "points": polydata.n_points,
+        "faces": polydata.n_cells,
+        "frames": scalars.shape[-1],
+    }
+    # e.g. PhaseField.from_signals
+    stage = ".".join(callable_name(phase_calculator).split(".")[-2:])
+    with span(profiler, stage, **sizes):
+        return phase_calculator(polydata, scalars, **phase_calculator_args)
+
+
+def put(cache, key, obj, profiler=None):
+    """``cache.put`` recorded as the ``pickle`` stage."""
+    with span(profiler, "pickle"):
+        cache.put(key, obj, evict=False)
+    if profiler is not None and cache.path(key).exists():
+        profiler.records[-1]["bytes"] = cache.path(key).stat().st_size
+
+
+def picklable(jobs):
+    """Whether the arguments of the jobs can be sent to worker processes."""
+    try:
+        pickle.dumps(jobs)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        print(f"jobs cannot be sent to worker processes ({e!r}), running serially")
+        return False
+    return True
+
+
+def run_map(phasefield_args, phasefield_key, methods, th, cache, profiler=None):
+    """Compute all missing methods of a single map.
+
+    The map is parsed and phase-computed at most once (or loaded from the
+    phase field stage of the cache) and shared by every method. This is a
+    module level function so it can be sent to worker processes.
+
+    Args:
+        phasefield_args (tuple): Arguments of ``compute_phasefield``.
+        phasefield_key (str): Cache key of the phase field stage.
+        methods (dict): Cache key of every method that has to be computed.
+        th (float): Phase difference threshold of the ``PhaseDiffFilter``.
+        cache (ResultCache): Result cache.
+        profiler (Profiler, optional): Records the stages of this map.
+
+    Returns:
+        dict: ``ExtendedPhaseMapping`` per method, the cache hits, misses and
+            evictions of this map under ``"cache"``, and the profiler records
+            under ``"profile"`` when profiling.
+    """
+    counts = (cache.hits, cache.misses, cache.evictions)
+    if profiler is not None:
+        # only the records of this map, they are sent back from workers
+        profiler.records = []
+        _, case, map, *_ = phasefield_args
+        context = profiler.context(case=case, map=map, method=None)
+    else:
+        context = nullcontext()
+
+    with context:
+        epms = _run_map(
+            phasefield_args, phasefield_key, methods, th, cache, profiler
+        )
+    if profiler is not None:
+        epms["profile"] = profiler.records
+    # counted on the copy of the cache in worker processes, sent back with the
+    # results
+    epms["cache"] = {
+        name: getattr(cache, name) - count
+        for name, count in zip(["hits", "misses", "evictions"], counts)
+    }
+    return epms
+
+
+def _run_map(phasefield_args, phasefield_key, methods, th, cache, profiler):
+    phasefield = cache.get(phasefield_key)
+    if phasefield is None:
+        phasefield = compute_phasefield(*phasefield_args, profiler=profiler)
+        put(cache, phasefield_key, phasefield, profiler)
+
+    epms = {}
+    for i, (method, key) in enumerate(methods.items()):
+        phasefield_filters, cycle_extractors = method_config(method, th)
+        if profiler is not None:
+            profiler.labels["method"] = method
+            profiler.set_sizes(**field_sizes(phasefield))
+            phasefield_filters = [profiler.wrap(f) for f in phasefield_filters]
+            cycle_extractors = [profiler.wrap(f) for f in cycle_extractors]
+        # filters may modify the phase field in place, so every method but the
+        # last one works on its own copy of the shared field
+        if i < len(methods) - 1:
+            method_phasefield = copy.deepcopy(phasefield)
+        else:
+            method_phasefield = phasefield
+        epm = ExtendedPhaseMapping(
+            method_phasefield, phasefield_filters, cycle_extractors
+        )
+        with span(profiler, "ExtendedPhaseMapping.run"):
+            epm.run()
+        put(cache, key, epm, profiler)
+        epms[method] = epm
+    return epms
+
+
 def multi_epm(
     parser,
     case,
@@ -19,44 +180,111 @@ def multi_epm(
     th,
     parser_args={},
     phase_calculator_args={},
+    cache=None,
+    n_workers=None,
+    profiler=None,
 ):
-    epms = []
-    for method in methods:
-        for map in maps:
-            filepath = (
-                Path(__file__).parent.parent.parent / f"pickle/{case}/{method}/{map}.pkl"
-            )
-            print(filepath)
-            if os.path.exists(filepath):
-            # if False:
-                with open(filepath, "rb") as f:
-                    epm = pickle.load(f)
+    """Run (extended) phase mapping for every combination of method and map.
+
+    Args:
+        parser (callable): ``parser(case, map, **parser_args)`` returning the
+            polydata and the scalars of a map.
+        case (str): Case identifier.
+        maps (list): Maps of the case to analyse.
+        phase_calculator (callable): Turns polydata and scalars into a
+            ``PhaseField``.
+        methods (list): ``"pm"`` and/or ``"epm"``.
+        th (float): Phase difference threshold of the ``PhaseDiffFilter``.
+        cache (ResultCache, optional): Result cache, defaults to
+            ``default_cache()``. Its ``stats()`` include the hits, misses and
+            evictions of worker processes.
+        n_workers (int, optional): Number of worker processes, each handling
+            one map at a time. ``None`` or 1 runs everything in the current
+            process.
+        profiler (Profiler, optional): Records wall time, peak RSS and input
+            sizes of every stage per case, map and method (see
+            ``Profiler.write_report``). Off by default.
+
+    Returns:
+        list: ``ExtendedPhaseMapping`` objects ordered by method, then map.
+    """
+    if cache is None:
+        cache = default_cache()
+
+    results = {}
+    todo = {}
+    for map in maps:
+        phasefield_key = cache_key(
+            stage="phasefield",
+            files=file_fingerprint(input_files(parser, case, map)),
+            case=case,
+            map=map,
+            parser=callable_name(parser),
+            parser_args=parser_args,
+            phase_calculator=callable_name(phase_calculator),
+            phase_calculator_args=phase_calculator_args,
+        )
+        missing = {}
+        for method in methods:
+            key = cache_key(phasefield=phasefield_key, th=th, method=method)
+            epm = cache.get(key)
+            if epm is None:
+                missing[method] = key
             else:
-                polydata, scalars = parser(case, map, **parser_args)
-                phasefield = phase_calculator(polydata, scalars, **phase_calculator_args)
-                
-                if method == "pm":
-                    phasefield_filters = []
-                    cycle_extractors = [ct.extract_face_cycles]
-                elif method == "epm":
-                    phasefield_filters = [
-                        ft.NaNFilter(),
-                        ft.PhaseDiffFilter(th),
-                    ]
-                    cycle_extractors = [
-                        ct.extract_face_cycles,
-                        ct.extract_boundary_cycles,
-                    ]
-
-                epm = ExtendedPhaseMapping(
-                    phasefield, phasefield_filters, cycle_extractors
-                )
-                epm.run()
-
-                os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                with open(filepath, "wb") as f:
-                    pickle.dump(epm, f)
-
-            epms.append(epm)
+                results[method, map] = epm
+        if missing:
+            phasefield_args = (
+                parser,
+                case,
+                map,
+                phase_calculator,
+                parser_args,
+                phase_calculator_args,
+            )
+            todo[map] = (
+                phasefield_args,
+                phasefield_key,
+                missing,
+                th,
+                cache,
+                profiler,
+            )
 
-    return epms
+    done = {}
+    jobs = list(todo.values())
+    if n_workers is not None and n_workers > 1 and len(todo) > 1 and picklable(jobs):
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(todo))) as pool:
+            try:
+                futures = {
+                    map: pool.submit(run_map, *args) for map, args in todo.items()
+                }
+            except OSError as e:
+                print(f"workers could not be started ({e!r}), continuing serially")
+                futures = {}
+            # errors raised by a job are not caught, they would happen serially too
+            for map, future in futures.items():
+                try:
+                    done[map] = future.result()
+                except BrokenProcessPool as e:
+                    print(f"worker process died ({e!r}), continuing serially")
+                    break
+        # entries written by the workers
+        cache.refresh_size()
+    remote = set(done)
+
+    records = [] if profiler is None else profiler.records
+    for map, args in todo.items():
+        if map not in done:
+            done[map] = run_map(*args)
+        records.extend(done[map].pop("profile", []))
+        counts = done[map].pop("cache")
+        if map in remote:
+            for name, count in counts.items():
+                setattr(cache, name, getattr(cache, name) + count)
+        for method, epm in done[map].items():
+            results[method, map] = epm
+    if profiler is not None:
+        profiler.records = records
+
+    cache.evict()
+    return [results[method, map] for method in methods for map in maps]
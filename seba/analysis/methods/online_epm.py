@@ -0,0 +1,161 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import cyclops.phasetools as ft
+from cyclops.extended_phasemapping import ExtendedPhaseMapping
+
+from analysis.methods.multi_epm import method_config
+
+
+class OnlineEPM:
+    """Incremental (extended) phase mapping over a stream of phase frames.
+
+    Every pushed chunk is wrapped in its own ``PhaseField`` and run through
+    the filters and cycle extractors of the chosen method. The resulting
+    cycles are shifted to global frame indices and appended to the cycle
+    tables, after which the frames are dropped. Memory therefore only grows
+    with the number of detected cycles, which can be bounded further with
+    ``history``.
+
+    The filters and extractors work frame by frame, so the frames have to be
+    phases already (e.g. written by ``PhaseMapTracker``). Phase calculators
+    that need the full signal, like ``PhaseField.from_signals``, cannot be
+    used online.
+    """
+
+    def __init__(self, polydata, method="epm", th=0.1 * np.pi, history=None, on_defect=None):
+        """
+        Args:
+            polydata (pv.PolyData): Geometry of the frames.
+            method (str, optional): ``"pm"`` or ``"epm"``.
+            th (float, optional): Phase difference threshold of the
+                ``PhaseDiffFilter``.
+            history (int, optional): Only keep the cycles of the last
+                ``history`` frames. ``None`` keeps everything.
+            on_defect (callable, optional): Called with the critical cycles of
+                every chunk in which at least one was found.
+        """
+        self.polydata = polydata
+        self.method = method
+        self.th = th
+        self.history = history
+        self.on_defect = on_defect
+        self.n_frames = 0
+        self.tables = {"critical_cycles": [], "noncritical_cycles": []}
+
+    @property
+    def critical_cycles(self):
+        return self._table("critical_cycles")
+
+    @property
+    def noncritical_cycles(self):
+        return self._table("noncritical_cycles")
+
+    def _table(self, name):
+        if not self.tables[name]:
+            return pd.DataFrame(columns=["time_axis"])
+        return pd.concat(self.tables[name], ignore_index=True)
+
+    def push(self, phases):
+        """Process a frame or a chunk of frames.
+
+        Args:
+            phases (np.ndarray): ``(n_points,)`` or ``(n_points, n_frames)``.
+
+        Returns:
+            bool: Whether a critical cycle (phase defect or singularity) was
+                found in this chunk.
+        """
+        phases = np.asarray(phases, dtype=float)
+        if phases.ndim == 1:
+            phases = phases[:, None]
+
+        phasefield_filters, cycle_extractors = method_config(self.method, self.th)
+        phasefield = ft.PhaseField(self.polydata.copy(), phases)
+        epm = ExtendedPhaseMapping(phasefield, phasefield_filters, cycle_extractors)
+        epm.run()
+
+        chunk = {}
+        for name in self.tables:
+            chunk[name] = getattr(epm, name).copy()
+            chunk[name]["time_axis"] += self.n_frames
+            self.tables[name].append(chunk[name])
+        self.n_frames += phases.shape[1]
+
+        # before _forget, which may drop cycles of this chunk with a short history
+        found = len(chunk["critical_cycles"]) > 0
+        if found and self.on_defect is not None:
+            self.on_defect(chunk["critical_cycles"])
+        self._forget()
+        return found
+
+    def _forget(self):
+        if self.history is None:
+            return
+        oldest = self.n_frames - self.history
+        for name, tables in self.tables.items():
+            tables = [table[table["time_axis"] >= oldest] for table in tables]
+            self.tables[name] = [table for table in tables if len(table)]
+
+    def consume(self, chunks, stop_on_defect=False):
+        """Push chunks from an iterable, e.g. ``follow_frames``.
+
+        Args:
+            chunks (iterable): Chunks of ``(n_points, n_frames)`` phases.
+            stop_on_defect (bool, optional): Stop at the first chunk with a
+                critical cycle.
+
+        Returns:
+            OnlineEPM: self
+        """
+        for chunk in chunks:
+            if self.push(chunk) and stop_on_defect:
+                break
+        return self
+
+
+def follow_frames(file_path, read_frames, chunk_size=50, poll_interval=1.0, timeout=60.0):
+    """Yield chunks of a tracker output file while it is being written.
+
+    The number of frames on disk is read from the ``.progress`` file written
+    by a streaming ``VoltageMapTracker``/``PhaseMapTracker``. Without it the
+    file is assumed to be complete.
+
+    Args:
+        file_path (str | Path): ``.npy`` output of the tracker.
+        read_frames (callable): ``read_frames(start, stop)`` returning the
+            frames ``start:stop`` as ``(n_points, n_frames)``.
+        chunk_size (int, optional): Number of frames per chunk.
+        poll_interval (float, optional): Seconds between progress checks.
+        timeout (float, optional): Stop when no new frames arrived for this
+            many seconds, e.g. because the simulation ended early. The frames
+            written until then are yielded as a last, shorter chunk.
+
+    Yields:
+        np.ndarray: Chunks of at most ``chunk_size`` frames.
+    """
+    file_path = Path(file_path)
+    progress_path = file_path.with_suffix(".progress")
+    n_total = np.load(file_path, mmap_mode="r").shape[0]
+
+    start = 0
+    waited = 0.0
+    while start < n_total:
+        available = n_total
+        if progress_path.exists():
+            available = int(progress_path.read_text())
+        if available - start >= chunk_size or available == n_total:
+            stop = min(start + chunk_size, available)
+            yield read_frames(start, stop)
+            start = stop
+            waited = 0.0
+            continue
+        if waited >= timeout:
+            # the writer stopped, still pass on the frames it did write
+            if available > start:
+                yield read_frames(start, available)
+            return
+        time.sleep(poll_interval)
+        waited += poll_interval
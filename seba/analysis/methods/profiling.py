@@ -0,0 +1,172 @@
+import cProfile
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+import pandas as pd
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def field_sizes(phasefield):
+    """Points, faces and frames of a ``PhaseField``."""
+    return {
+        "points": phasefield.polydata.n_points,
+        "faces": phasefield.polydata.n_cells,
+        "frames": len(phasefield.time_axis),
+    }
+
+
+def _original(obj):
+    return obj
+
+
+class TimedProxy:
+    """Wraps a filter object or a cycle extractor function, so every call is
+    recorded as a stage of a ``Profiler``. It pickles as the wrapped object,
+    so results that keep a reference to it can still be cached."""
+
+    def __init__(self, obj, profiler, stage):
+        self._obj = obj
+        self._profiler = profiler
+        self._stage = stage
+
+    def __call__(self, *args, **kwargs):
+        with self._profiler.span(self._stage):
+            return self._obj(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            with self._profiler.span(self._stage):
+                return attr(*args, **kwargs)
+
+        return timed
+
+    def __reduce__(self):
+        return _original, (self._obj,)
+
+
+class Profiler:
+    """Opt-in stage timing of ``multi_epm``.
+
+    Every stage (parser, phase calculator, each filter and cycle extractor,
+    the phase mapping as a whole and pickling to the cache) is recorded with
+    its wall time, the peak RSS of the process after the stage and the input
+    sizes that are known at that point, labelled with the current case, map
+    and method.
+    """
+
+    def __init__(self, profile_stage=None, profile_dir="profiles"):
+        """
+        Args:
+            profile_stage (str, optional): Name of a stage to run under
+                ``cProfile``, e.g. ``"PhaseDiffFilter"``. Every call of the
+                stage is dumped to its own ``.prof`` file.
+            profile_dir (str | Path, optional): Directory of the dumps.
+        """
+        self.profile_stage = profile_stage
+        self.profile_dir = Path(profile_dir)
+        self.labels = {}
+        self.sizes = {}
+        self.records = []
+
+    @contextmanager
+    def context(self, **labels):
+        """Label all stages recorded inside, e.g. with the case and map."""
+        previous = self.labels, self.sizes
+        self.labels = {**self.labels, **labels}
+        self.sizes = dict(self.sizes)
+        try:
+            yield self
+        finally:
+            self.labels, self.sizes = previous
+
+    @contextmanager
+    def span(self, stage, **sizes):
+        """Record the wall time of the enclosed block as ``stage``."""
+        profile = None
+        if stage == self.profile_stage:
+            profile = cProfile.Profile()
+            profile.enable()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            wall_time = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                self.profile_dir.mkdir(parents=True, exist_ok=True)
+                name = "_".join(str(v) for v in [stage, *self.labels.values()])
+                name = name.replace("/", "_").replace(" ", "_")
+                profile.dump_stats(self.profile_dir / f"{name}_{len(self.records)}.prof")
+            self.records.append(
+                {
+                    **self.labels,
+                    "stage": stage,
+                    "wall_time": wall_time,
+                    "peak_rss_mb": peak_rss_mb(),
+                    **self.sizes,
+                    **sizes,
+                }
+            )
+
+    def set_sizes(self, **sizes):
+        """Input sizes attached to the stages recorded after this call."""
+        self.sizes.update(sizes)
+
+    def wrap(self, obj, stage=None):
+        """``TimedProxy`` of a filter or a cycle extractor."""
+        if stage is None:
+            stage = getattr(obj, "__name__", type(obj).__name__)
+        return TimedProxy(obj, self, stage)
+
+    def extend(self, records):
+        """Add records collected in another process."""
+        self.records.extend(records)
+
+    def table(self):
+        return pd.DataFrame(self.records)
+
+    def summary(self):
+        """Total wall time and maximum peak RSS per stage."""
+        table = self.table()
+        if table.empty:
+            return table
+        return (
+            table.groupby("stage")
+            .agg(
+                calls=("wall_time", "size"),
+                wall_time=("wall_time", "sum"),
+                peak_rss_mb=("peak_rss_mb", "max"),
+            )
+            .sort_values("wall_time", ascending=False)
+        )
+
+    def write_report(self, path):
+        """Write all records to ``{path}.json`` and ``{path}.csv``."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        json_file = path.with_suffix(".json")
+        json_file.write_text(json.dumps(self.records, indent=2, default=str))
+        csv_file = path.with_suffix(".csv")
+        self.table().to_csv(csv_file, index=False)
+        return json_file, csv_file
+
+
+def span(profiler, stage, **sizes):
+    """``profiler.span`` or a no-op when profiling is off."""
+    if profiler is None:
+        return nullcontext()
+    return profiler.span(stage, **sizes)
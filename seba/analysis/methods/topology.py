@@ -0,0 +1,101 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyvista as pv
+from cyclops.parsetools import parse_utils
+
+TOPOLOGY_DIR = Path(__file__).parent.parent.parent / "pickle/topology"
+
+# topologies that were already loaded or built in this process
+_topologies = {}
+
+
+def grid_hash(grid):
+    """Hash of the geometry (shape, dtype and values) of a grid."""
+    grid = np.ascontiguousarray(grid)
+    h = hashlib.sha256(f"{grid.shape}{grid.dtype}".encode())
+    h.update(grid.tobytes())
+    return h.hexdigest()
+
+
+def build_quad_topology(grid):
+    """Vertices and quads of a regular grid, without quads touching holes.
+
+    Args:
+        grid (np.ndarray): 2D mesh, holes are marked with 0.
+
+    Returns:
+        tuple: ``(n_points, 3)`` vertex coordinates and ``(n_quads, 4)``
+            vertex indices.
+    """
+    nx, ny = grid.shape
+    idx = np.arange(nx * ny).reshape((nx, ny))
+    quads = np.stack(
+        [
+            idx[:-1, :-1].ravel(),  # corner 0
+            idx[1:, :-1].ravel(),  # corner 1
+            idx[1:, 1:].ravel(),  # corner 2
+            idx[:-1, 1:].ravel(),  # corner 3
+        ],
+        axis=1,
+    )  # shape (M, 4)
+
+    is_hole = (grid == 0).ravel()
+    quads = quads[~is_hole[quads].any(axis=1)]
+
+    vertices = np.zeros((nx * ny, 3))
+    vertices[:, 0] = np.repeat(np.arange(nx), ny)
+    vertices[:, 1] = np.tile(np.arange(ny), nx)
+    return vertices, quads
+
+
+def to_dataframes(vertices, quads):
+    vertices = pd.DataFrame(vertices, columns=["x", "y", "z"])
+    quads = pd.DataFrame(quads, columns=[f"vertex_{i}" for i in range(4)])
+    return vertices, quads
+
+
+def quad_topology(grid, cache_dir=TOPOLOGY_DIR):
+    """Cached vertices, quads and polydata of a grid.
+
+    Topologies are keyed by ``grid_hash`` and kept in memory as well as on
+    disk (``{key}.npz`` for the arrays and ``{key}.vtp`` for the polydata),
+    so maps that share a geometry only build it once.
+
+    Args:
+        grid (np.ndarray): 2D mesh, holes are marked with 0.
+        cache_dir (str | Path, optional): Directory of the on-disk cache.
+
+    Returns:
+        tuple: vertices, quads and the assembled ``pv.PolyData``. These are
+            shared, copy them before modifying.
+    """
+    key = grid_hash(grid)
+    if key in _topologies:
+        return _topologies[key]
+
+    cache_dir = Path(cache_dir)
+    arrays_file = cache_dir / f"{key}.npz"
+    polydata_file = cache_dir / f"{key}.vtp"
+    if arrays_file.exists() and polydata_file.exists():
+        arrays = np.load(arrays_file)
+        vertices, quads = arrays["vertices"], arrays["quads"]
+        polydata = pv.read(polydata_file)
+    else:
+        vertices, quads = build_quad_topology(grid)
+        polydata = parse_utils.parse_to_polydata(*to_dataframes(vertices, quads))
+
+        os.makedirs(cache_dir, exist_ok=True)
+        pid = os.getpid()
+        tmp_file = cache_dir / f"{key}.{pid}.tmp.npz"
+        np.savez(tmp_file, vertices=vertices, quads=quads)
+        os.replace(tmp_file, arrays_file)
+        tmp_file = cache_dir / f"{key}.{pid}.tmp.vtp"
+        polydata.save(tmp_file, binary=True)
+        os.replace(tmp_file, polydata_file)
+
+    _topologies[key] = vertices, quads, polydata
+    return _topologies[key]
@@ -1,3 +1,6 @@
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import pyvista as pv
 
@@ -7,16 +10,113 @@ from cyclops.visualtools.widgets.slider import Slider
 from analysis.visualization.cmaps import dcmap
 
 
+_MISSING = object()
+
+
+def frame_values(field, name, timestep):
+    """Values of the scalar array ``name`` of a field at a timestep, or
+    ``None`` if the array is not a (points, frames) or (frames, points)
+    array."""
+    values = np.asarray(field[name])
+    n_points = field.polydata.n_points
+    n_frames = len(field.time_axis)
+    if values.ndim != 2:
+        return None
+    if values.shape == (n_points, n_frames):
+        return values[:, timestep]
+    if values.shape == (n_frames, n_points):
+        return values[timestep]
+    return None
+
+
+class FrameCache:
+    """Thread-safe LRU cache of built PyVista objects, bounded in bytes.
+
+    Keys are ``(subplot, object type, timestep)``. A cached ``None`` means
+    that there is nothing to show for the key.
+    """
+
+    def __init__(self, max_bytes=2 * 1024**3):
+        """
+        Args:
+            max_bytes (int, optional): Memory budget of the cached objects.
+                The least recently used objects are dropped beyond it.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    def get(self, key):
+        """Cached object of ``key``, or ``_MISSING``."""
+        with self._lock:
+            if key not in self._frames:
+                self.misses += 1
+                return _MISSING
+            self.hits += 1
+            self._frames.move_to_end(key)
+            return self._frames[key]
+
+    def put(self, key, pv_obj):
+        size = 0 if pv_obj is None else pv_obj.actual_memory_size * 1024
+        with self._lock:
+            if key in self._frames:
+                self.nbytes -= self._sizes[key]
+            self._frames[key] = pv_obj
+            self._frames.move_to_end(key)
+            self._sizes[key] = size
+            self.nbytes += size
+            # always keep the newest object, even if it alone is too large
+            while self.nbytes > self.max_bytes and len(self._frames) > 1:
+                old, _ = self._frames.popitem(last=False)
+                self.nbytes -= self._sizes.pop(old)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+
 class MultiSlider(Slider):
     """Loads data of multiple datasets into a single slider plot, with subplots
-    containing each dataset"""
+    containing each dataset.
+
+    Built objects are kept in a ``FrameCache`` per (subplot, object type,
+    timestep), and a background thread builds the ``prefetch`` timesteps
+    on either side of the current one, so moving the slider mostly only swaps
+    the inputs of the mappers.
 
-    def __init__(self, data_list, shape):
+    Objects in ``scalar_fields`` have a fixed geometry. Their mesh is built
+    once and only its active point array is replaced in place every
+    timestep. Scalar bars are added once, by ``add_scalar_bars``."""
+
+    scalar_fields = ("phasefield",)
+
+    def __init__(
+        self, data_list, shape, cache_bytes=2 * 1024**3, prefetch=8, off_screen=False
+    ):
         """
         Args:
             data_list (list): List of EPM objects.
             shape (tuple[int,int], optional): Grid shape (rows, cols).
                 If None, will try to guess a square-ish grid.
+            cache_bytes (int, optional): Memory budget of the frame cache.
+            prefetch (int, optional): Number of timesteps before and after
+                the current one that are built in the background. 0 disables
+                prefetching.
+            off_screen (bool, optional): Render without a window, e.g. to
+                export frames on a machine without a display.
         """
         self.data = []
         self.builders = []
@@ -26,12 +126,34 @@ class MultiSlider(Slider):
         self.current_time_index = 0
 
         self.shape = shape
-        self.plotter = pv.Plotter(shape=self.shape, border=False)
+        self.plotter = pv.Plotter(shape=self.shape, border=False, off_screen=off_screen)
         self.load_data(data_list)
 
+        self.cache = FrameCache(cache_bytes)
+        self.prefetch = prefetch
+        self._prefetch_target = None
+        self._prefetch_event = threading.Event()
+        self._prefetch_thread = None
+        self._closed = False
+        # meshes of the scalar fields that are updated in place
+        self.meshes = {}
+        self.scalar_bars_added = False
+
     def load_data(self):
         pass
 
+    def build(self, i, obj_type, timestep):
+        """Built object of a subplot at a timestep, from the cache if
+        possible."""
+        key = (i, obj_type, timestep)
+        pv_obj = self.cache.get(key)
+        if pv_obj is _MISSING:
+            data = self.data[i].get(obj_type)
+            builder = self.builders[i][obj_type]
+            pv_obj = builder.build(data, self.configs[obj_type], timestep)
+            self.cache.put(key, pv_obj)
+        return pv_obj
+
     def update_objects(self, timestep):
         """Update all subplots at a given timestep."""
         for i in range(len(self.data)):
@@ -40,33 +162,114 @@ class MultiSlider(Slider):
             self.plotter.subplot(row, col)
 
             for obj_type in self.visible_objects:
-                data = self.data[i].get(obj_type)
-                builder = self.builders[i][obj_type]
                 cfg = self.configs[obj_type]
+                actor = self.actors[i][obj_type]
+                if (i, obj_type) in self.meshes:
+                    self.update_scalars(i, obj_type, timestep)
+                    continue
 
-                if self.actors[i][obj_type] is None:
-                    pv_obj = builder.build(data, cfg, timestep)
+                pv_obj = self.build(i, obj_type, timestep)
+                if actor is None:
                     if pv_obj is not None:
+                        if obj_type in self.scalar_fields:
+                            pv_obj = self.own_mesh(i, obj_type, pv_obj, timestep)
                         self.actors[i][obj_type] = self.plotter.add_mesh(pv_obj, **cfg)
                         self.plotter.reset_camera()
-                    else:
-                        self.actors[i][obj_type] = None
+                elif pv_obj is not None:
+                    actor.mapper.SetInputData(pv_obj)
+                    actor.SetVisibility(True)
                 else:
-                    actor = self.actors[i][obj_type]
-                    pv_obj = actor.mapper.GetInput()
-                    updated = builder.update(data, cfg, timestep)
-                    if updated is not None:
-                        self.actors[i][obj_type].mapper.SetInputData(updated)
-                    else:
-                        self.plotter.remove_actor(self.actors[i][obj_type])
-                        self.actors[i][obj_type] = None
+                    # hidden instead of removed, so it is not added again
+                    actor.SetVisibility(False)
+        if not self.scalar_bars_added:
+            self.add_scalar_bars()
+            self.scalar_bars_added = True
         self.plotter.render()
+        self.prefetch_around(timestep)
+
+    def own_mesh(self, i, obj_type, pv_obj, timestep):
+        """Copy of a built scalar field that is updated in place from now on,
+        if its active array can be taken from the data."""
+        name = self.configs[obj_type]["scalars"]
+        values = frame_values(self.data[i][obj_type], name, timestep)
+        if name not in pv_obj.point_data or values is None:
+            return pv_obj
+        if pv_obj.point_data[name].shape != values.shape:
+            return pv_obj
+        mesh = pv_obj.copy()
+        self.meshes[i, obj_type] = mesh
+        return mesh
+
+    def update_scalars(self, i, obj_type, timestep):
+        """Replace the active array of a scalar field in place."""
+        mesh = self.meshes[i, obj_type]
+        name = self.configs[obj_type]["scalars"]
+        mesh.point_data[name][:] = frame_values(self.data[i][obj_type], name, timestep)
+        mesh.Modified()
+
+    def add_scalar_bars(self):
+        """Add the scalar bars, called once after the first update."""
+        pass
+
+    def prefetch_around(self, timestep):
+        """Let the background thread build the timesteps around
+        ``timestep``."""
+        if self.prefetch <= 0 or self._closed:
+            return
+        if self._prefetch_thread is None:
+            self._prefetch_thread = threading.Thread(
+                target=self._prefetch_loop, daemon=True
+            )
+            self._prefetch_thread.start()
+        self._prefetch_target = timestep
+        self._prefetch_event.set()
+
+    def _prefetch_order(self, timestep):
+        n_frames = len(self.time_axis)
+        for offset in range(1, self.prefetch + 1):
+            for t in (timestep + offset, timestep - offset):
+                if 0 <= t < n_frames:
+                    yield t
+
+    def _prefetch_loop(self):
+        # builders of this thread, the ones of the subplots are used by the
+        # main thread
+        builders = [
+            {obj_type: type(builder)() for obj_type, builder in sub.items()}
+            for sub in self.builders
+        ]
+        while not self._closed:
+            self._prefetch_event.wait()
+            self._prefetch_event.clear()
+            for timestep in self._prefetch_order(self._prefetch_target):
+                # start over when the slider moved
+                if self._prefetch_event.is_set() or self._closed:
+                    break
+                for i in range(len(self.data)):
+                    for obj_type in list(self.visible_objects):
+                        key = (i, obj_type, timestep)
+                        if key in self.cache or (i, obj_type) in self.meshes:
+                            continue
+                        data = self.data[i].get(obj_type)
+                        cfg = self.configs[obj_type]
+                        self.cache.put(
+                            key, builders[i][obj_type].build(data, cfg, timestep)
+                        )
+
+    def close(self):
+        """Stop prefetching and close the plotter."""
+        self._closed = True
+        self._prefetch_event.set()
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join()
+        self.plotter.close()
 
     def show(self):
         """Show the slider with all subplots."""
         self.update_objects(timestep=self.current_time_index)
         self.add_time_slider()
         self.plotter.show()
+        self.close()
 
     def add_time_slider(self):
         """Add a single time slider controlling all subplots."""
@@ -88,13 +291,13 @@ class MultiSlider(Slider):
 
 
 class EPMMultiSlider(MultiSlider):
-    def __init__(self, epm_list):
+    def __init__(self, epm_list, **kwargs):
         self.time_axis = epm_list[0].phasefield.time_axis
         n = len(epm_list)
         rows = int(np.floor(np.sqrt(n)))
         cols = int(np.ceil(n / rows))
         shape = (rows, cols)
-        super().__init__(epm_list, shape)
+        super().__init__(epm_list, shape, **kwargs)
 
     def load_data(self, epm_list):
         """
@@ -191,56 +394,53 @@ class EPMMultiSlider(MultiSlider):
             self.configs["critical_cycles"]["cmap"], int(max_tc * 2 + 1)
         )
 
-    def update_objects(self, timestep):
-        super().update_objects(timestep)
-
-        if timestep == self.current_time_index:
-            scalar_names = [
-                _
-                for _ in self.visible_objects
-                if self.configs[_]["scalars"] is not None
-            ][::-1]
-            for i, scalar_name in enumerate(scalar_names):
-                dummy = pv.Sphere(theta_resolution=4, phi_resolution=4)
-                dummy["dummy"] = np.linspace(0, 1, dummy.n_points)  # values 0→1
-                dummy["dummy"][0] = np.nan
-                if scalar_name == "critical_cycles":
-                    fmt = "%.1f"
-                    n_labels = int(self.configs["critical_cycles"]["clim"][1] * 2 + 1)
-                    nan_annotation = False
-                else:
-                    fmt = "%.2f"
-                    n_labels = 5
-                    nan_annotation = True
-                row, col = self.shape
-                self.plotter.subplot(row - 1, col - 1 - i)
-                actor = self.plotter.add_mesh(
-                    dummy,
-                    scalars="dummy",
-                    cmap=self.configs[scalar_name]["cmap"],
-                    clim=self.configs[scalar_name]["clim"],  # desired range
-                    opacity=0.0,  # invisible
-                    show_scalar_bar=False,
-                    
-                )
-                scalar_bar_actor = self.plotter.add_scalar_bar(
-                    title=["Phase Index", "Phase"][i],
-                    mapper=actor.mapper,
-                    vertical=False,  # bar on the right
-                    position_x=0.1,  # move it outside right
-                    position_y=0.1,  # vertical placement
-                    width=0.8,
-                    height=0.05,  # size
-                    title_font_size=80,
-                    label_font_size=40,
-                    fmt=fmt,
-                    n_labels=n_labels,
-                    nan_annotation=nan_annotation
-                )
+    def add_scalar_bars(self):
+        scalar_names = [
+            _
+            for _ in self.visible_objects
+            if self.configs[_]["scalars"] is not None
+        ][::-1]
+        for i, scalar_name in enumerate(scalar_names):
+            dummy = pv.Sphere(theta_resolution=4, phi_resolution=4)
+            dummy["dummy"] = np.linspace(0, 1, dummy.n_points)  # values 0→1
+            dummy["dummy"][0] = np.nan
+            if scalar_name == "critical_cycles":
+                fmt = "%.1f"
+                n_labels = int(self.configs["critical_cycles"]["clim"][1] * 2 + 1)
+                nan_annotation = False
+            else:
+                fmt = "%.2f"
+                n_labels = 5
+                nan_annotation = True
+            row, col = self.shape
+            self.plotter.subplot(row - 1, col - 1 - i)
+            actor = self.plotter.add_mesh(
+                dummy,
+                scalars="dummy",
+                cmap=self.configs[scalar_name]["cmap"],
+                clim=self.configs[scalar_name]["clim"],  # desired range
+                opacity=0.0,  # invisible
+                show_scalar_bar=False,
+                
+            )
+            scalar_bar_actor = self.plotter.add_scalar_bar(
+                title=["Phase Index", "Phase"][i],
+                mapper=actor.mapper,
+                vertical=False,  # bar on the right
+                position_x=0.1,  # move it outside right
+                position_y=0.1,  # vertical placement
+                width=0.8,
+                height=0.05,  # size
+                title_font_size=80,
+                label_font_size=40,
+                fmt=fmt,
+                n_labels=n_labels,
+                nan_annotation=nan_annotation
+            )
 
 
 class PhaseFieldMultiSlider(MultiSlider):
-    def __init__(self, epm_list, scalar_name="Voltage", scalars="scalars"):
+    def __init__(self, epm_list, scalar_name="Voltage", scalars="scalars", **kwargs):
         self.scalars = scalars
         self.scalar_name = scalar_name
         self.time_axis = epm_list[0].phasefield.time_axis
@@ -248,7 +448,7 @@ class PhaseFieldMultiSlider(MultiSlider):
         rows = 1
         cols = n
         shape = (rows, cols)
-        super().__init__(epm_list, shape)
+        super().__init__(epm_list, shape, **kwargs)
 
     def load_data(self, epm_list):
         min_scalar, max_scalar = 0, 0
@@ -292,8 +492,7 @@ class PhaseFieldMultiSlider(MultiSlider):
 
         self.configs["phasefield"]["clim"] = [min_scalar, max_scalar]
 
-    def update_objects(self, timestep):
-        super().update_objects(timestep)
+    def add_scalar_bars(self):
         self.plotter.add_scalar_bar(
             title=self.scalar_name,
             position_x=0.1,  # move it outside right
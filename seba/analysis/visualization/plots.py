@@ -1,17 +1,161 @@
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import ffmpeg
+import numpy as np
+
+from analysis.methods.multi_epm import picklable
 from analysis.visualization.custom_cyclops_classes import EPMMultiSlider, PhaseFieldMultiSlider
 
-def multi_slider(epms, scalar_name, show="comparison"):
+def multi_slider(epms, scalar_name, show="comparison", **kwargs):
     if show == "comparison":
-        slider = EPMMultiSlider(epms)
+        slider = EPMMultiSlider(epms, **kwargs)
         # slider.visible_objects = ["phasefield"]
         slider.visible_objects = ["phasefield", "critical_cycles"]
         # slider.visible_objects = ["phasefield", "critical_cycles", "noncritical_cycles"]
     elif show == "phasefield":
-        slider = PhaseFieldMultiSlider(epms, scalar_name)
-        
+        slider = PhaseFieldMultiSlider(epms, scalar_name, **kwargs)
+
     slider.plotter.link_views()
     slider.plotter.camera_position = "xy"
     slider.plotter.camera.zoom(1.5)
     return slider
 
 
+def render_frames(epms, scalar_name, show, timesteps, first, reference, frame_dir,
+                  window_size):
+    """Render timesteps of a multi slider offscreen to numbered PNG files.
+
+    Args:
+        epms (list): EPM objects of the subplots.
+        scalar_name (str): Scalar name of a phase field slider.
+        show (str): ``"comparison"`` or ``"phasefield"``, see ``multi_slider``.
+        timesteps (list): Timesteps to render.
+        first (int): Frame number of the first timestep.
+        reference (int): Timestep that sets the camera, the same in every
+            worker, so the frames of all workers line up.
+        frame_dir (Path): Output directory of ``frame_{number:06d}.png``.
+        window_size (tuple[int, int]): Frame size in pixels.
+
+    Returns:
+        int: Number of rendered frames.
+    """
+    slider = multi_slider(epms, scalar_name, show, off_screen=True, prefetch=0)
+    slider.plotter.window_size = window_size
+    slider.update_objects(reference)
+    cameras = [renderer.camera_position for renderer in slider.plotter.renderers]
+
+    for n, timestep in enumerate(timesteps):
+        slider.update_objects(int(timestep))
+        # new actors reset the camera
+        for renderer, camera in zip(slider.plotter.renderers, cameras):
+            renderer.camera_position = camera
+        slider.plotter.screenshot(Path(frame_dir) / f"frame_{first + n:06d}.png")
+    slider.close()
+    return len(timesteps)
+
+
+def export_video(
+    epms,
+    output,
+    scalar_name=None,
+    show="comparison",
+    every=1,
+    start=0,
+    stop=None,
+    fps=20,
+    window_size=(1920, 1080),
+    n_workers=None,
+):
+    """Render a multi slider offscreen to an MP4 or an image sequence.
+
+    The timesteps are split into contiguous ranges that are rendered by
+    worker processes, each with its own offscreen plotter, and the frames are
+    stitched with ffmpeg. Without a display VTK needs offscreen support (an
+    EGL or OSMesa build) or a virtual framebuffer such as Xvfb.
+
+    Args:
+        epms (list): EPM objects of the subplots.
+        output (str | Path): Video file (e.g. ``movie.mp4``), or a directory
+            without suffix to keep the PNG frames.
+        scalar_name (str, optional): Scalar name of a phase field slider.
+        show (str, optional): ``"comparison"`` or ``"phasefield"``, see
+            ``multi_slider``.
+        every (int, optional): Render every k-th timestep.
+        start (int, optional): First timestep.
+        stop (int, optional): Timestep to stop before, defaults to the end.
+        fps (int, optional): Frame rate of the video.
+        window_size (tuple[int, int], optional): Frame size in pixels.
+        n_workers (int, optional): Number of worker processes. ``None`` or 1
+            renders in the current process.
+
+    Returns:
+        Path: The video file or the frame directory.
+
+    Raises:
+        ValueError: If ``start:stop:every`` contains no timesteps.
+    """
+    output = Path(output)
+    n_frames = len(epms[0].phasefield.time_axis)
+    timesteps = np.arange(start, n_frames if stop is None else stop, every)
+    if not len(timesteps):
+        raise ValueError(
+            f"No timesteps to render in {start}:{stop}:{every} of {n_frames} frames"
+        )
+
+    if not output.suffix:
+        output.mkdir(parents=True, exist_ok=True)
+        _render(epms, scalar_name, show, timesteps, output, window_size, n_workers)
+        return output
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    frame_dir = Path(tempfile.mkdtemp(prefix="frames_", dir=output.parent))
+    try:
+        _render(epms, scalar_name, show, timesteps, frame_dir, window_size, n_workers)
+        (
+            ffmpeg.input(str(frame_dir / "frame_%06d.png"), framerate=fps)
+            # libx264 with yuv420p needs even dimensions
+            .filter("pad", "ceil(iw/2)*2", "ceil(ih/2)*2")
+            .output(str(output), vcodec="libx264", pix_fmt="yuv420p")
+            .overwrite_output()
+            .run(quiet=True)
+        )
+    finally:
+        shutil.rmtree(frame_dir)
+    return output
+
+
+def _render(epms, scalar_name, show, timesteps, frame_dir, window_size, n_workers):
+    n_workers = 1 if n_workers is None else max(1, min(n_workers, len(timesteps)))
+    chunks = np.array_split(timesteps, n_workers)
+    firsts = np.cumsum([0] + [len(chunk) for chunk in chunks[:-1]])
+    jobs = [
+        (epms, scalar_name, show, chunk, int(first), int(timesteps[0]), frame_dir,
+         window_size)
+        for chunk, first in zip(chunks, firsts)
+    ]
+
+    done = set()
+    if n_workers > 1 and picklable(jobs):
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            try:
+                futures = [pool.submit(render_frames, *job) for job in jobs]
+            except OSError as e:
+                print(f"workers could not be started ({e!r}), continuing serially")
+                futures = []
+            # errors raised while rendering are not caught, they would happen
+            # serially too
+            for i, future in enumerate(futures):
+                try:
+                    future.result()
+                except BrokenProcessPool as e:
+                    print(f"worker process died ({e!r}), continuing serially")
+                    break
+                done.add(i)
+    for i, job in enumerate(jobs):
+        if i not in done:
+            render_frames(*job)
+    print(f"rendered {len(timesteps)} frames to {frame_dir}")
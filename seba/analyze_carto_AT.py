@@ -1,3 +1,5 @@
+from pathlib import Path
+
 import numpy as np
 
 import cyclops.parsetools as pt
@@ -31,6 +33,15 @@ def parse_carto_mesh(case: str, filename: str):
     return polydata, polydata["LAT"]
 
 
+def carto_mesh_files(case, filename):
+    """The ``.mesh`` file of a map and the exports that share its name."""
+    mesh_file = Path(parse_utils.get_case_file(case, filename, suffix=".mesh"))
+    return sorted(mesh_file.parent.glob(f"{filename}*")) or [mesh_file]
+
+
+parse_carto_mesh.input_files = carto_mesh_files
+
+
 if __name__ == "__main__":
     # show simulations
     show = "phasefield"
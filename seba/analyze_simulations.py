@@ -7,51 +7,118 @@ from analysis.visualization.plots import multi_slider
 sys.path.append(str(Path(__file__).resolve().parents[2]))
 
 import numpy as np
-import pandas as pd
 import cyclops.phasetools as ft
 from cyclops.parsetools import parse_utils
 
 from analysis.methods.multi_epm import multi_epm
+from analysis.methods.online_epm import follow_frames
+from analysis.methods.topology import quad_topology, to_dataframes
 
 
-def parse_finitewave_mesh(case, filename):
-    vertices, quads, scalars = load_finitewave_mesh(case, filename)
-    return parse_utils.parse_to_polydata(vertices, quads), scalars
+def parse_finitewave_mesh(case, filename, start=0, stop=None, stride=1):
+    grid, scalars = load_finitewave_grid(case, filename, start, stop, stride)
+    _, _, polydata = quad_topology(grid)
+    return polydata.copy(), scalars
 
 
-def load_finitewave_mesh(case, filename):
+def finitewave_mesh_files(case, filename):
+    scalars_file = Path(
+        parse_utils.get_case_file(
+            case, filename.replace("mesh", "scalars"), suffix=".npy"
+        )
+    )
+    return [
+        parse_utils.get_case_file(case, filename, suffix=".npy"),
+        scalars_file,
+        scalars_file.with_name(f"{scalars_file.stem}_layout.npz"),
+    ]
+
+
+parse_finitewave_mesh.input_files = finitewave_mesh_files
+
+
+def load_finitewave_scalars(scalars_file, grid, start=0, stop=None, stride=1):
+    """Load a window of simulation output as a ``(n_points, n_frames)`` array.
+
+    The file is memory-mapped and only the frames ``start:stop:stride`` are
+    read, straight into the output array. The result is the transpose of a
+    C-contiguous ``(n_frames, n_points)`` array, so no other full-size copy
+    is made.
+
+    Args:
+        scalars_file (str | Path): Output of ``VoltageMapTracker``.
+        grid (np.ndarray): Mesh without its boundary cells. Points that are
+            not myocardium (``grid != 1``) are set to NaN.
+        start (int, optional): First frame.
+        stop (int, optional): Frame to stop at (exclusive).
+        stride (int, optional): Step between frames.
+
+    Compact outputs (see ``VoltageMapTracker.compact``) only contain the
+    active cells and are scattered directly onto the inner grid points.
+    """
+    scalars_file = Path(scalars_file)
+    layout_file = scalars_file.with_name(f"{scalars_file.stem}_layout.npz")
+    window = np.load(scalars_file, mmap_mode="r")[start:stop:stride]
+    n_frames = window.shape[0]
+    nx, ny = grid.shape
+    dtype = np.result_type(window.dtype, np.float32)
+
+    if not layout_file.exists():
+        scalars = np.empty((n_frames, nx, ny), dtype=dtype)
+        scalars[:] = window[:, 1:-1, 1:-1]
+        scalars[:, grid != 1] = np.nan
+        return scalars.reshape(n_frames, -1).T
+
+    layout = np.load(layout_file)
+    i, j = np.divmod(layout["index"], layout["shape"][1])
+    inner = (i >= 1) & (i <= nx) & (j >= 1) & (j <= ny)
+    columns = (i[inner] - 1) * ny + j[inner] - 1
+
+    scalars = np.full((n_frames, nx * ny), np.nan, dtype=dtype)
+    chunk = 256
+    for k in range(0, n_frames, chunk):
+        scalars[k : k + chunk, columns] = window[k : k + chunk][:, inner]
+    scalars[:, grid.ravel() != 1] = np.nan
+    return scalars.T
+
+
+def load_finitewave_grid(case, filename, start=0, stop=None, stride=1):
     grid_file = parse_utils.get_case_file(case, filename, suffix=".npy")
     grid = np.load(grid_file)[1:-1, 1:-1]
     scalars_file = parse_utils.get_case_file(
         case, filename.replace("mesh", "scalars"), suffix=".npy"
     )
-    scalars = np.load(scalars_file)[:, 1:-1, 1:-1]
-    scalars[:, grid != 1] = np.nan
+    scalars = load_finitewave_scalars(scalars_file, grid, start, stop, stride)
+    return grid, scalars
 
-    nx, ny = grid.shape
-    coords = np.argwhere(grid != -1)
-    idx = np.arange(nx * ny).reshape((nx, ny))
-    quads = np.stack(
-        [
-            idx[:-1, :-1].ravel(),  # corner 0
-            idx[1:, :-1].ravel(),  # corner 1
-            idx[1:, 1:].ravel(),  # corner 2
-            idx[:-1, 1:].ravel(),  # corner 3
-        ],
-        axis=1,
-    )  # shape (M, 4)
-
-    hole_indices = idx[grid == 0].flatten()
-    quads = quads[~np.isin(quads, hole_indices).any(axis=1)]
-
-    coords = np.stack([coords[:, 0], coords[:, 1], np.zeros(coords.shape[0])], axis=1)
-    vertices = pd.DataFrame(coords, columns=["x", "y", "z"])
-    quads = pd.DataFrame(quads, columns=[f"vertex_{i}" for i in range(4)])
-    scalars = scalars.reshape(scalars.shape[0], -1).T
 
+def load_finitewave_mesh(case, filename, start=0, stop=None, stride=1):
+    grid, scalars = load_finitewave_grid(case, filename, start, stop, stride)
+    vertices, quads, _ = quad_topology(grid)
+    vertices, quads = to_dataframes(vertices, quads)
     return vertices, quads, scalars
 
 
+def follow_finitewave_mesh(case, filename, chunk_size=50, poll_interval=1.0, timeout=60.0):
+    """Polydata and a generator of phase chunks of a simulation that is
+    still running (see ``OnlineEPM``). The mesh file has to be written before
+    the run starts, and the phases streamed by a ``PhaseMapTracker``, as
+    ``build_scenario(..., track_phase=True)`` does. The voltage maps cannot
+    be used, ``OnlineEPM`` expects phases."""
+    grid_file = parse_utils.get_case_file(case, filename, suffix=".npy")
+    grid = np.load(grid_file)[1:-1, 1:-1]
+    scalars_file = parse_utils.get_case_file(
+        case, filename.replace("mesh", "phase"), suffix=".npy"
+    )
+    _, _, polydata = quad_topology(grid)
+
+    def read_frames(start, stop):
+        return load_finitewave_scalars(scalars_file, grid, start, stop)
+
+    chunks = follow_frames(scalars_file, read_frames, chunk_size, poll_interval, timeout)
+    return polydata.copy(), chunks
+
+
 if __name__ == "__main__":
     # show simulations
     show = "phasefield"
@@ -64,13 +131,14 @@ if __name__ == "__main__":
     # scalar_name = None
 
     parser = parse_finitewave_mesh
+    parser_args = dict(start=0, stop=None, stride=1)  # frame window
     case = "square"
     # maps = [f"mesh{i}" for i in range(1, 5)]
     maps = [f"mesh{i}" for i in [5, 6, 2, 7]]
 
     phase_calculator = ft.PhaseField.from_signals
     th = 0.1 * np.pi
-    epms = multi_epm(parser, case, maps, phase_calculator, methods, th)
+    epms = multi_epm(parser, case, maps, phase_calculator, methods, th, parser_args)
     slider = multi_slider(epms, scalar_name, show)
     slider.show()
     
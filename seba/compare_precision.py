@@ -0,0 +1,115 @@
+"""Runs square scenarios in double and single precision and compares the
+activation times and the detected phase defects."""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import cyclops.phasetools as ft
+
+# Make sure that the simulation classes are on sys.path
+sys.path.append(str(Path(__file__).resolve().parent / "simulation"))
+
+from create_simulations import run_scenario
+from analysis.methods.multi_epm import multi_epm
+from analyze_simulations import load_finitewave_grid, parse_finitewave_mesh
+
+
+def activation_frames(scalars, threshold=0.5):
+    """Frames at which every point crosses ``threshold`` upwards.
+
+    Args:
+        scalars (np.ndarray): ``(n_points, n_frames)`` voltages.
+        threshold (float, optional): Activation threshold.
+
+    Returns:
+        list: Per point, an array with its activation frames.
+    """
+    above = np.nan_to_num(scalars, nan=-np.inf) > threshold
+    points, frames = np.nonzero(above[:, 1:] & ~above[:, :-1])
+    return np.split(frames + 1, np.searchsorted(points, np.arange(1, len(scalars))))
+
+
+def compare_activations(reference, other, dt_output):
+    """Differences in activation times between two runs.
+
+    Args:
+        reference (np.ndarray): ``(n_points, n_frames)`` voltages.
+        other (np.ndarray): ``(n_points, n_frames)`` voltages.
+        dt_output (float): Time between frames.
+
+    Returns:
+        dict: Mean and maximum absolute difference of the matched activation
+            times and the number of points with a different number of
+            activations.
+    """
+    differences = []
+    mismatches = 0
+    for a, b in zip(activation_frames(reference), activation_frames(other)):
+        if len(a) != len(b):
+            mismatches += 1
+        n = min(len(a), len(b))
+        differences.append(np.abs(a[:n] - b[:n]))
+    differences = np.concatenate(differences) * dt_output
+    return {
+        "activation_mean": differences.mean() if len(differences) else 0.0,
+        "activation_max": differences.max() if len(differences) else 0.0,
+        "activation_count_mismatch": mismatches,
+    }
+
+
+def compare_defects(reference, other):
+    """Differences in the critical cycles (phase defects and singularities)
+    detected by extended phase mapping.
+
+    Args:
+        reference (ExtendedPhaseMapping): Result of the reference run.
+        other (ExtendedPhaseMapping): Result of the other run.
+
+    Returns:
+        dict: Number of critical cycles in both runs and the Jaccard index of
+            the frames in which they were found.
+    """
+    frames_reference = set(reference.critical_cycles["time_axis"])
+    frames_other = set(other.critical_cycles["time_axis"])
+    union = frames_reference | frames_other
+    return {
+        "defects_reference": len(reference.critical_cycles),
+        "defects_other": len(other.critical_cycles),
+        "defect_frames_jaccard": (
+            len(frames_reference & frames_other) / len(union) if union else 1.0
+        ),
+    }
+
+
+def compare_precision(test, dtypes=("float64", "float32"), th=0.1 * np.pi, **params):
+    """Runs a scenario in two precisions and reports how far they diverge.
+
+    Args:
+        test (int): Scenario of ``square_setup``.
+        dtypes (tuple, optional): Reference and other precision.
+        th (float, optional): Phase difference threshold of the EPM.
+        **params: Parameters of ``build_scenario``.
+
+    Returns:
+        dict: Output of ``compare_activations`` and ``compare_defects``.
+    """
+    for dtype in dtypes:
+        run_scenario(test, name=f"{test}_{dtype}", dtype=dtype, **params)
+
+    case = "square"
+    maps = [f"mesh{test}_{dtype}" for dtype in dtypes]
+    reference, other = (load_finitewave_grid(case, map)[1] for map in maps)
+    report = compare_activations(reference, other, params.get("dt_output", 0.5))
+
+    epms = multi_epm(
+        parse_finitewave_mesh, case, maps, ft.PhaseField.from_signals, ["epm"], th
+    )
+    report.update(compare_defects(*epms))
+    return report
+
+
+if __name__ == "__main__":
+    for test in [2, 4, 7]:
+        report = compare_precision(test)
+        print(f"test {test}: " + ", ".join(f"{k}={v:.3g}" for k, v in report.items()))
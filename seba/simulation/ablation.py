@@ -0,0 +1,256 @@
+"""Tests ablation geometries by branching from a checkpoint just before ablation."""
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numba
+import numpy as np
+import pandas as pd
+import finitewave as fw
+
+from create_simulations import path, build_scenario
+from custom_fw_classes import ActivityTracker, compute_spans
+from sweep import init_worker, split_cores
+
+
+def _ablation_command(model):
+    # the ablation is the last command of build_scenario
+    return model.command_sequence.sequence[-1]
+
+
+def checkpoint(test, path=path, num_of_threads=None, **params):
+    """
+    Runs a scenario up to its ablation time and saves the model state.
+
+    The state (u, v, mesh, weights, t and step) is stored in
+    ``path/checkpoints`` under a hash of the scenario, so it is only computed
+    once per scenario and parameter set.
+
+    Parameters
+    ----------
+    test : int
+        Scenario of ``square_setup``.
+    path : Path
+        Output directory.
+    num_of_threads : int, optional
+        Numba threads of the simulation.
+    **params
+        Parameters of ``build_scenario``.
+
+    Returns
+    -------
+    Path
+        The ``.npz`` checkpoint file.
+    """
+    key = hashlib.sha1(
+        json.dumps({"test": test, **params}, sort_keys=True, default=repr).encode()
+    ).hexdigest()[:12]
+    checkpoint_file = Path(path).joinpath(f"checkpoints/{test}_{key}.npz")
+    if checkpoint_file.exists():
+        return checkpoint_file
+
+    model, _, _ = build_scenario(
+        test, path, num_of_threads=num_of_threads, track=False, **params
+    )
+    ablation = model.command_sequence.sequence.pop()
+    model.t_max = ablation.t
+    model.run(num_of_theads=num_of_threads)
+
+    checkpoint_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = checkpoint_file.with_name(f"{checkpoint_file.stem}.{os.getpid()}.tmp.npz")
+    np.savez(
+        tmp_file,
+        u=model.u,
+        v=model.v,
+        mesh=model.cardiac_tissue.mesh,
+        weights=model.weights,
+        t=model.t,
+        step=model.step,
+    )
+    os.replace(tmp_file, checkpoint_file)
+    return checkpoint_file
+
+
+def run_branch(
+    checkpoint_file,
+    test,
+    ablation_matrix,
+    threshold=0.1,
+    dt_output=0.5,
+    num_of_threads=None,
+    **params,
+):
+    """
+    Continues a checkpoint with a different ablation geometry.
+
+    Parameters
+    ----------
+    checkpoint_file : Path
+        Output of ``checkpoint`` for the same scenario and parameters.
+    test : int
+        Scenario of ``square_setup``.
+    ablation_matrix : np.ndarray
+        Cells to ablate (non-zero).
+    threshold : float
+        Voltage above which a cell counts as excited.
+    dt_output : float
+        Time between activity samples.
+    num_of_threads : int, optional
+        Numba threads of the simulation.
+    **params
+        Parameters of ``build_scenario``.
+
+    Returns
+    -------
+    dict
+        Outcome of the branch: ``terminated``, ``t_termination`` (in
+        scenario time, i.e. including the prepacing), ``excited`` (number of
+        excited cells at the end) and ``wall_time``.
+    """
+    start = time.perf_counter()
+    model, _, _ = build_scenario(
+        test, num_of_threads=num_of_threads, track=False, dt_output=dt_output, **params
+    )
+    # the state is restored from the checkpoint instead
+    model.state_loader = None
+
+    ablation = _ablation_command(model)
+    ablation.temp_scar = ablation_matrix
+
+    activity_tracker = ActivityTracker()
+    activity_tracker.step = dt_output
+    activity_tracker.threshold = threshold
+    model.tracker_sequence = fw.TrackerSequence()
+    model.tracker_sequence.add_tracker(activity_tracker)
+
+    model.initialize()
+    state = np.load(checkpoint_file)
+    model.cardiac_tissue.mesh[:] = state["mesh"]
+    model.cardiac_tissue.compute_myo_indexes()
+    model.weights = state["weights"]
+    model.spans = compute_spans(model.cardiac_tissue.mesh)
+    model.u[:] = state["u"]
+    model.u_new[:] = state["u"]
+    model.v[:] = state["v"]
+    model.t = float(state["t"])
+    model.step = int(state["step"])
+
+    # everything before the checkpoint already happened
+    for stim in model.stim_sequence.sequence:
+        if stim.t + stim.duration <= model.t:
+            stim.passed = True
+    for command in model.command_sequence.sequence:
+        if command is not ablation and command.t <= model.t:
+            command.passed = True
+    ablation.execute(model)
+    ablation.passed = True
+
+    model.run(initialize=False, num_of_theads=num_of_threads)
+
+    # scenario time, independent of the prepaced offset
+    offset = params.get("t_start", 30) if params.get("prepaced", True) else 0
+    t_termination = activity_tracker.t_termination
+    return {
+        "terminated": t_termination is not None,
+        "t_termination": None if t_termination is None else t_termination + offset,
+        "excited": activity_tracker.counts[-1] if activity_tracker.counts else None,
+        "wall_time": time.perf_counter() - start,
+    }
+
+
+def what_if(
+    test,
+    ablations,
+    path=path,
+    n_workers=None,
+    threads_per_worker=None,
+    threshold=0.1,
+    **params,
+):
+    """
+    Simulates the post-ablation interval of a scenario for many ablation
+    geometries.
+
+    The scenario is simulated once up to the ablation time (see
+    ``checkpoint``), after which every ablation runs as its own branch in a
+    process pool.
+
+    Parameters
+    ----------
+    test : int
+        Scenario of ``square_setup``.
+    ablations : dict or list
+        Ablation matrices, by name. A list is named by its indices.
+    path : Path
+        Output directory.
+    n_workers : int, optional
+        Number of branches running at the same time.
+    threads_per_worker : int, optional
+        Numba threads per branch. By default the cores are divided over the
+        workers.
+    threshold : float
+        Voltage above which a cell counts as excited.
+    **params
+        Parameters of ``build_scenario``.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per ablation with the outcome of ``run_branch``.
+    """
+    if not isinstance(ablations, dict):
+        ablations = dict(enumerate(ablations))
+
+    n_workers, threads_per_worker = split_cores(
+        len(ablations), n_workers, threads_per_worker
+    )
+    n_cores = os.cpu_count() or 1
+
+    checkpoint_file = checkpoint(
+        test,
+        path,
+        num_of_threads=min(n_cores, numba.config.NUMBA_NUM_THREADS),
+        **params,
+    )
+    print(f"checkpoint: {checkpoint_file}")
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=init_worker,
+        initargs=(threads_per_worker,),
+    ) as pool:
+        futures = {
+            name: pool.submit(
+                run_branch,
+                checkpoint_file,
+                test,
+                ablation_matrix,
+                threshold=threshold,
+                num_of_threads=threads_per_worker,
+                path=path,
+                **params,
+            )
+            for name, ablation_matrix in ablations.items()
+        }
+        results = {name: future.result() for name, future in futures.items()}
+
+    return pd.DataFrame.from_dict(results, orient="index").rename_axis("ablation")
+
+
+if __name__ == "__main__":
+    # ablation lines from the scar to the boundary at different positions
+    test = 2
+    scale = 5
+    ni = nj = 39 * scale
+    ablations = {}
+    for offset in [-2, -1, 0, 1, 2]:
+        ablation_matrix = np.zeros((ni, nj), dtype=int)
+        ablation_matrix[: ni // 2, nj // 2 + offset * scale] = 1
+        ablations[f"line_{offset}"] = ablation_matrix
+
+    results = what_if(test, ablations, scale=scale)
+    print(results)
@@ -1,12 +1,22 @@
 """Performs finite wave simulation using Aliev Panfilov cell model for a 2D square."""
 
+import hashlib
+import json
+import os
+import shutil
 from pathlib import Path
 from matplotlib import pyplot as plt
 import numpy as np
 import finitewave as fw
 
 from setup import square_setup
-from custom_fw_classes import VoltageMapTracker, ModifiedAlievPanfilov2D
+from custom_fw_classes import (
+    VoltageMapTracker,
+    PhaseMapTracker,
+    ModifiedAlievPanfilov2D,
+    update_weights_region,
+)
+from telemetry import Telemetry
 
 root = Path(__file__).parent.parent.parent.parent
 path = root.joinpath(f"dgm_database/fw_sim/Seba")
@@ -14,57 +24,101 @@ path = root.joinpath(f"dgm_database/fw_sim/Seba")
 # root = Path(__file__).parent
 # path = root.joinpath("output")
 
-# Simulation configurations
-# test = 1  # complete rotation around a functional block
-# test = 2  # complete rotation around scar
-# test = 3  # complete rotation around hole
-# test = 4  # compelte rotation around a hybrid phase barrier
-# test = 5  # simple parallel activation around a scar
-# test = 6  # complex parallel activation around a scar
-# test = 7  # near-complete rotation around a scar
 
-test = 4
+# Adjust scar command
+class AdjustScar(fw.Command):
+    def __init__(self, time, temp_scar, tag, scars_matrix, holes_matrix):
+        super().__init__(time)
+        self.temp_scar = temp_scar
+        self.tag = tag
+        self.scars_matrix = scars_matrix
+        self.holes_matrix = holes_matrix
+
+    def adjust_mesh(self, mesh):
+        mesh[np.nonzero(self.scars_matrix)] = 2
+        mesh[np.nonzero(self.temp_scar)] = self.tag
+        mesh[np.nonzero(self.holes_matrix)] = 0
+
+    def execute(self, model):
+        self.adjust_mesh(model.cardiac_tissue.mesh)
+        model.cardiac_tissue.add_boundaries()
+        model.compute_weights()
+
+
+class AdjustScarRegion(AdjustScar):
+    """
+    ``AdjustScar`` that only recomputes the weights, ``myo_indexes`` and
+    spans inside the bounding box of the cells that changed, plus a one-cell
+    halo, instead of for the whole tissue.
+    """
+
+    @property
+    def box(self):
+        """Bounding box of the cells this command can touch."""
+        return bounding_box(
+            (np.asarray(self.temp_scar) != 0)
+            | (np.asarray(self.scars_matrix) != 0)
+            | (np.asarray(self.holes_matrix) != 0)
+        )
+
+    def execute(self, model):
+        box = self.box
+        if box is None:
+            return
+        rows, cols = box
+        mesh = model.cardiac_tissue.mesh
+        old = mesh[rows, cols].copy()
+        region = mesh[rows, cols]
+        region[np.nonzero(self.scars_matrix[rows, cols])] = 2
+        region[np.nonzero(self.temp_scar[rows, cols])] = self.tag
+        region[np.nonzero(self.holes_matrix[rows, cols])] = 0
+        model.cardiac_tissue.add_boundaries()
+
+        changed = bounding_box(mesh[rows, cols] != old)
+        if changed is None:
+            return
+        ni, nj = mesh.shape
+        # the weights of the neighbours of changed cells change as well
+        update_weights_region(
+            model,
+            slice(max(rows.start + changed[0].start - 1, 0),
+                  min(rows.start + changed[0].stop + 1, ni)),
+            slice(max(cols.start + changed[1].start - 1, 0),
+                  min(cols.start + changed[1].stop + 1, nj)),
+        )
 
-# for test in range(1, 8):
-# for test in [1, 6]:
-for test in [test]:
-    # Parameters
-    # time
-    dt = 0.01  # t[ms] = 12.9*t
-    dt_output = 0.5
-    t_max = 400
-    t_start = 30  # end prepacing time
-    t_stable = 28  # block removal timing
-    t_extra_stim = [i*2*t_stable for i in range(1, 10)]
-    t_ablation = 189 - 28  # ablation timing
 
+def bounding_box(mask):
+    """Row and column slices of the non-zero cells, ``None`` if there are none."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+
+def create_model(scale=5, cond=0.2, a=0.15, dt=0.01, dtype="float64"):
+    """
+    Creates the model and the (scar free) square tissue for a given scale,
+    simulated in precision ``dtype``.
+    """
     # space
     dr = 0.5  # arbitrary unit
     ni, nj = 39, 39
-    scale = 5
-    SC_eps = 4 # scar radius
-    ST_eps = 4 # stimulus radius
-    H_eps = 2 * SC_eps  # hole_radius
-
-    # conduction
-    cond = 0.2 # cond[dr_unit/ms] = cond / 12.9 = 0.016
 
     # Rescale dimensions
     ni *= scale
     nj *= scale
     cond *= scale
-    SC_eps *= scale
-    ST_eps *= scale
-    H_eps *= scale
     ni = int(ni)
     nj = int(nj)
 
     # Create model object
     aliev_panfilov = ModifiedAlievPanfilov2D()
-    aliev_panfilov.a = np.ones([ni, nj])*0.15
+    aliev_panfilov.npfloat = np.dtype(dtype).name
+    aliev_panfilov.a = np.ones([ni, nj], dtype=dtype)*a
     aliev_panfilov.dt = dt
     aliev_panfilov.dr = dr
-    aliev_panfilov.t_max = t_max + t_start
 
     # Tissue
     tissue = fw.CardiacTissue2D([ni, nj])
@@ -72,6 +126,162 @@ for test in [test]:
     tissue.add_boundaries()
     tissue.conductivity = np.ones(tissue.mesh.shape) * cond
     aliev_panfilov.cardiac_tissue = tissue
+    return aliev_panfilov, tissue
+
+
+def prepaced_state(
+    scale=5,
+    cond=0.2,
+    a=0.15,
+    t_start=30,
+    dt=0.01,
+    dtype="float64",
+    path=path,
+    num_of_threads=None,
+):
+    """
+    Directory with the model state at ``t_start`` after prepacing.
+
+    Prepacing (a full tissue stimulus at t=0, simulated up to ``t_start``)
+    is the same for every scenario with the same grid and model parameters,
+    so the state is computed once with a ``StateSaver`` and stored under a
+    hash of those parameters in ``path/prepaced``.
+
+    Returns
+    -------
+    Path
+        Directory to pass to a ``StateLoader``.
+    """
+    aliev_panfilov, tissue = create_model(scale, cond, a, dt, dtype)
+    aliev_panfilov.t_max = t_start
+
+    model_parameters = {
+        name: getattr(aliev_panfilov, name, None)
+        for name in ["k", "eap", "mu_1", "mu_2", "D_model", "dr", "npfloat"]
+    }
+    key = hashlib.sha1(
+        json.dumps(
+            dict(
+                shape=tissue.mesh.shape,
+                cond=cond * scale,
+                a=a,
+                t_start=t_start,
+                dt=dt,
+                **model_parameters,
+            ),
+            sort_keys=True,
+            default=repr,
+        ).encode()
+    ).hexdigest()[:12]
+    state_dir = Path(path).joinpath(f"prepaced/{key}")
+    if state_dir.exists():
+        return state_dir
+
+    tmp_dir = state_dir.with_name(f"{key}.{os.getpid()}.tmp")
+    stim_sequence = fw.StimSequence()
+    stim_sequence.add_stim(
+        fw.StimVoltageMatrix2D(0, 1, np.ones_like(tissue.mesh))
+    )  # prepacing
+    aliev_panfilov.stim_sequence = stim_sequence
+    aliev_panfilov.state_saver = fw.StateSaver(str(tmp_dir))
+    aliev_panfilov.run(num_of_theads=num_of_threads)
+
+    try:
+        os.replace(tmp_dir, state_dir)
+    except OSError:
+        # another process stored the same state in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return state_dir
+
+
+def build_scenario(
+    test,
+    path=path,
+    name=None,
+    scale=5,
+    cond=0.2,  # cond[dr_unit/ms] = cond / 12.9 = 0.016
+    SC_eps=4,  # scar radius
+    ST_eps=4,  # stimulus radius
+    a=0.15,
+    t_stable=28,  # block removal timing
+    t_ablation=189 - 28,  # ablation timing
+    t_max=400,
+    t_start=30,  # end prepacing time
+    dt=0.01,  # t[ms] = 12.9*t
+    dt_output=0.5,
+    dtype="float64",
+    active_set=False,
+    prepaced=True,
+    num_of_threads=None,
+    track=True,
+    track_phase=False,
+):
+    """
+    Builds the model of a square test scenario, ready to be run.
+
+    Parameters
+    ----------
+    test : int
+        Scenario of ``square_setup``.
+    path : Path
+        Output directory, results are written to ``path/square``.
+    name : str, optional
+        Suffix of the output files ``scalars{name}`` and ``mesh{name}``.
+        Defaults to the test number.
+    scale, cond, SC_eps, ST_eps, a, t_stable, t_ablation : float
+        Scenario parameters, see the defaults.
+    dtype : str
+        Precision of the simulation and of the stored voltage maps, e.g.
+        ``"float32"``.
+    active_set : bool
+        Only update the cells near activity, see ``ModifiedAlievPanfilov2D``.
+    prepaced : bool
+        Start from the cached state after prepacing (see ``prepaced_state``)
+        instead of simulating it. All event times are then shifted by
+        ``-t_start``, so the output frames are the same.
+    num_of_threads : int, optional
+        Threads used to compute the prepaced state if it is not cached yet.
+    track : bool
+        Add the voltage map tracker and save the mesh. Without it the
+        returned tracker is ``None``.
+    track_phase : bool
+        Also stream the phase of every output frame to ``phase{name}`` with a
+        ``PhaseMapTracker``, e.g. to follow the run with ``OnlineEPM``.
+
+    Returns
+    -------
+    tuple
+        The model, its voltage map tracker and the setup matrices.
+    """
+    if name is None:
+        name = f"{test}"
+    name = f"{name}".replace(".", "_")
+
+    # Parameters
+    # time
+    t_extra_stim = [i*2*t_stable for i in range(1, 10)]
+
+    # space
+    H_eps = 2 * SC_eps  # hole_radius
+
+    # Rescale dimensions
+    SC_eps *= scale
+    ST_eps *= scale
+    H_eps *= scale
+
+    aliev_panfilov, tissue = create_model(scale, cond, a, dt, dtype)
+    aliev_panfilov.t_max = t_max + t_start
+    aliev_panfilov.active_set = active_set
+
+    # the prepaced state already covers [0, t_start]
+    offset = 0
+    if prepaced:
+        state_dir = prepaced_state(
+            scale, cond, a, t_start, dt, dtype, path, num_of_threads
+        )
+        aliev_panfilov.state_loader = fw.StateLoader(str(state_dir))
+        offset = t_start
+        aliev_panfilov.t_max -= offset
 
     # Setup scars, stimuli and ablations
     (
@@ -82,73 +292,88 @@ for test in [test]:
         extra_stimuli_matrix,
         ablation_matrix,
     ) = square_setup(test, aliev_panfilov, H_eps, SC_eps, ST_eps)
-
-    # Show simulation setup
-    fig, ax = plt.subplots()
-    matrix = tissue.mesh
-    for i, m in enumerate(
-        [
-            scars_matrix,
-            holes_matrix,
-            temp_scars_matrix,
-            stimuli_matrix,
-            extra_stimuli_matrix,
-            ablation_matrix,
-            aliev_panfilov.a,
-            aliev_panfilov.cardiac_tissue.conductivity
-        ]
-    ):
-        matrix = matrix + (i + 2) * m
-    ax.imshow(matrix, cmap="rainbow")
-    # plt.show()
+    matrices = dict(
+        scars_matrix=scars_matrix,
+        holes_matrix=holes_matrix,
+        temp_scars_matrix=temp_scars_matrix,
+        stimuli_matrix=stimuli_matrix,
+        extra_stimuli_matrix=extra_stimuli_matrix,
+        ablation_matrix=ablation_matrix,
+    )
 
     # Set up stimulation parameters
     stim_sequence = fw.StimSequence()
-    stim_sequence.add_stim(
-        fw.StimVoltageMatrix2D(0, 1, np.ones_like(tissue.mesh))
-    )  # prepacing
-    stim_sequence.add_stim(fw.StimVoltageMatrix2D(t_start, 1, stimuli_matrix))
+    if not prepaced:
+        stim_sequence.add_stim(
+            fw.StimVoltageMatrix2D(0, 1, np.ones_like(tissue.mesh))
+        )  # prepacing
+    stim_sequence.add_stim(fw.StimVoltageMatrix2D(t_start - offset, 1, stimuli_matrix))
     for t in t_extra_stim:
         stim_sequence.add_stim(
-            fw.StimVoltageMatrix2D(t_start + t_stable + t, 1, extra_stimuli_matrix)
+            fw.StimVoltageMatrix2D(t_start - offset + t_stable + t, 1, extra_stimuli_matrix)
         )
 
     # Set up animation tracker
-    umap_tracker = VoltageMapTracker()
-    umap_tracker.path = path
-    umap_tracker.step = dt_output
-    umap_tracker.start = t_start
-    umap_tracker.dir_name = "square"
-    umap_tracker.file_name = f"scalars{test}".replace(".", "_")
+    umap_tracker = None
     tracker_sequence = fw.TrackerSequence()
-    tracker_sequence.add_tracker(umap_tracker)
-
+    if track:
+        umap_tracker = VoltageMapTracker()
+        umap_tracker.path = path
+        umap_tracker.step = dt_output
+        umap_tracker.start = t_start - offset
+        umap_tracker.dir_name = "square"
+        umap_tracker.file_name = f"scalars{name}"
+        umap_tracker.stream = True  # write frames to disk as they are sampled
+        # only store cells that are still myocardium after all scar commands
+        final_mesh = tissue.mesh.copy()
+        final_mesh[np.nonzero(scars_matrix)] = 2
+        final_mesh[np.nonzero(ablation_matrix)] = 2
+        final_mesh[np.nonzero(holes_matrix)] = 0
+        umap_tracker.compact = True
+        umap_tracker.mask = final_mesh == 1
+        # save the mesh up front, so the output can be analysed while running
+        Path(path).joinpath("square").mkdir(parents=True, exist_ok=True)
+        np.save(Path(path).joinpath(f"square/mesh{name}"), final_mesh)
+        tracker_sequence.add_tracker(umap_tracker)
 
-    # Adjust scar command
-    class AdjustScar(fw.Command):
-        def __init__(self, time, temp_scar, tag):
-            super().__init__(time)
-            self.temp_scar = temp_scar
-            self.tag = tag
-
-        def execute(self, model):
-            model.cardiac_tissue.mesh[np.nonzero(scars_matrix)] = 2
-            model.cardiac_tissue.mesh[np.nonzero(self.temp_scar)] = self.tag
-            model.cardiac_tissue.mesh[np.nonzero(holes_matrix)] = 0
-
-            tissue.add_boundaries()
-            model.compute_weights()
+        if track_phase:
+            phase_tracker = PhaseMapTracker()
+            phase_tracker.path = path
+            phase_tracker.step = dt_output
+            phase_tracker.start = t_start - offset
+            phase_tracker.dir_name = "square"
+            phase_tracker.file_name = f"phase{name}"
+            phase_tracker.stream = True
+            phase_tracker.compact = True
+            phase_tracker.mask = umap_tracker.mask
+            tracker_sequence.add_tracker(phase_tracker)
 
     # Create command sequence
     command_sequence = fw.CommandSequence()
+    block = AdjustScarRegion(
+        t_start - offset, temp_scars_matrix, 2, scars_matrix, holes_matrix
+    )
+    if prepaced:
+        # Commands run at the end of a step, so a command at t = 0 would miss
+        # the stimulus of the first step. Without prepacing the block is in
+        # place before the stimulus at t_start, so it is applied up front.
+        block.adjust_mesh(tissue.mesh)
+        tissue.add_boundaries()
+    else:
+        command_sequence.add_command(block)  # add temp block
     command_sequence.add_command(
-        AdjustScar(t_start, temp_scars_matrix, 2)
-    )  # add temp block
-    command_sequence.add_command(
-        AdjustScar(t_start + t_stable, temp_scars_matrix, 1)
+        AdjustScarRegion(
+            t_start - offset + t_stable, temp_scars_matrix, 1, scars_matrix, holes_matrix
+        )
     )  # remove temp block
     command_sequence.add_command(
-        AdjustScar(t_start + t_stable + t_ablation, ablation_matrix, 2)
+        AdjustScarRegion(
+            t_start - offset + t_stable + t_ablation,
+            ablation_matrix,
+            2,
+            scars_matrix,
+            holes_matrix,
+        )
     )  # ablate
 
     # Add the sequence to the model
@@ -156,9 +381,83 @@ for test in [test]:
     aliev_panfilov.stim_sequence = stim_sequence
     aliev_panfilov.tracker_sequence = tracker_sequence
     aliev_panfilov.command_sequence = command_sequence
+    return aliev_panfilov, umap_tracker, matrices
+
+
+def plot_setup(model, matrices):
+    """Show simulation setup"""
+    fig, ax = plt.subplots()
+    matrix = model.cardiac_tissue.mesh
+    for i, m in enumerate(
+        [
+            *matrices.values(),
+            model.a,
+            model.cardiac_tissue.conductivity
+        ]
+    ):
+        matrix = matrix + (i + 2) * m
+    ax.imshow(matrix, cmap="rainbow")
+    return fig
+
+
+def run_scenario(test, path=path, name=None, num_of_threads=None, show_setup=False,
+                 telemetry=None, **params):
+    """
+    Builds and runs a square test scenario and saves its output.
+
+    With ``telemetry`` (seconds between reports) the time spent in the
+    kernels, stimuli, trackers and commands is reported during the run and
+    summarised at the end.
+
+    Returns
+    -------
+    tuple
+        Paths of the written scalars and mesh files, ``(None, None)`` with
+        ``track=False``.
+    """
+    aliev_panfilov, umap_tracker, matrices = build_scenario(
+        test, path, name, num_of_threads=num_of_threads, **params
+    )
+    if show_setup:
+        plot_setup(aliev_panfilov, matrices)
+        # plt.show()
+
     aliev_panfilov.initialize()
-    aliev_panfilov.run(initialize=False)
+    if telemetry is None:
+        aliev_panfilov.run(initialize=False, num_of_theads=num_of_threads)
+    else:
+        timer = Telemetry(aliev_panfilov, report_every=telemetry).attach()
+        try:
+            aliev_panfilov.run(initialize=False, num_of_theads=num_of_threads)
+        finally:
+            timer.detach()
+        print(timer.format())
 
     # Save data
-    umap_tracker.write()
-    np.save(path.joinpath(f"square/mesh{test}".replace(".", "_")), tissue.mesh)
+    for tracker in aliev_panfilov.tracker_sequence.sequence:
+        tracker.write()
+    if umap_tracker is None:
+        return None, None
+    mesh_file = umap_tracker.file_path.with_name(
+        umap_tracker.file_name.replace("scalars", "mesh", 1) + ".npy"
+    )
+    np.save(mesh_file, aliev_panfilov.cardiac_tissue.mesh)
+    return umap_tracker.file_path, mesh_file
+
+
+if __name__ == "__main__":
+    # Simulation configurations
+    # test = 1  # complete rotation around a functional block
+    # test = 2  # complete rotation around scar
+    # test = 3  # complete rotation around hole
+    # test = 4  # compelte rotation around a hybrid phase barrier
+    # test = 5  # simple parallel activation around a scar
+    # test = 6  # complex parallel activation around a scar
+    # test = 7  # near-complete rotation around a scar
+
+    test = 4
+
+    # for test in range(1, 8):
+    # for test in [1, 6]:
+    for test in [test]:
+        run_scenario(test, show_setup=True)
@@ -1,19 +1,65 @@
+import copy
 import os
+import warnings
 from pathlib import Path
 import numpy as np
-import numpy as np
 from numba import njit, prange
+from scipy import ndimage
 
 from finitewave.core.tracker.tracker import Tracker
 from finitewave.cpuwave2D.model import AlievPanfilov2D
 
 class VoltageMapTracker(Tracker):
+    """
+    Tracks the full voltage map every ``step`` time units from ``start``.
+
+    By default the maps are kept in memory and saved by ``write``. With
+    ``stream = True`` every sampled frame is written straight into a
+    memory-mapped ``.npy`` file instead. The file is created with its final
+    shape, so it can be opened with ``open_voltage_map`` while the simulation
+    is still running; a ``.progress`` file next to it holds the number of
+    frames that have been flushed to disk.
+
+    With ``compact = True`` only the active cells are stored, as an
+    ``(n_frames, n_active)`` array. Their flat grid indices and the grid
+    shape are saved once in ``{file_name}_layout.npz``.
+
+    Attributes
+    ----------
+    stream : bool
+        Write frames to a memory-mapped file instead of keeping them in RAM.
+    dtype : numpy.dtype, optional
+        Storage dtype of the voltage maps (e.g. ``np.float32``). Defaults to
+        the dtype of the model state.
+    flush_every : int
+        Number of frames between flushes of the memory-mapped file.
+    compact : bool
+        Only store the active cells of the tissue.
+    n_dropped : int
+        Number of sampled frames that did not fit the preallocated maps, e.g.
+        after restoring a later state or changing ``t_max``. A warning is
+        issued for the first one and when writing.
+    mask : np.ndarray, optional
+        Boolean grid of the cells to store in compact mode. Defaults to the
+        myocardium (``mesh == 1``) at initialisation. Pass the final mesh
+        when scars or holes are added by commands during the run.
+    """
+
     def __init__(self):
         Tracker.__init__(self)
         self.dir_name = "output"
         self.file_name = "u"
         self.start = 0
         self.step = 1
+        self.stream = False
+        self.dtype = None
+        self.flush_every = 50
+        self.compact = False
+        self.mask = None
+
+    @property
+    def file_path(self):
+        return Path(self.path).joinpath(self.dir_name).joinpath(f"{self.file_name}.npy")
 
     def initialize(self, model):
         self.model = model
@@ -21,32 +67,486 @@ class VoltageMapTracker(Tracker):
         dt = self.step
         t_range = int((t_max - self.start) / dt) + 1
 
-        self.u_map = np.zeros((t_range, *self.model.u.shape))
         if not os.path.exists(Path(self.path).joinpath(self.dir_name)):
             Path(self.path).joinpath(self.dir_name).mkdir(parents=True)
 
+        shape = (t_range, *self.model.u.shape)
+        if self.compact:
+            mask = self.mask
+            if mask is None:
+                mask = self.model.cardiac_tissue.mesh == 1
+            self.index = np.flatnonzero(mask)
+            np.savez(
+                self.file_path.with_name(f"{self.file_name}_layout.npz"),
+                index=self.index,
+                shape=self.model.u.shape,
+            )
+            shape = (t_range, len(self.index))
+        else:
+            # a layout of an earlier compact run would be applied to this output
+            self.file_path.with_name(f"{self.file_name}_layout.npz").unlink(missing_ok=True)
+
+        dtype = self.dtype
+        if dtype is None:
+            dtype = self.model.u.dtype
+
+        self.n_frames = 0
+        self.n_dropped = 0
+        if self.stream:
+            self.u_map = np.lib.format.open_memmap(
+                self.file_path, mode="w+", dtype=dtype, shape=shape
+            )
+            self._write_progress()
+        else:
+            self.u_map = np.zeros(shape, dtype=dtype)
+
+    def track(self):
+        # sampling is handled by _track, since step and start are in time units
+        self._track()
+
     def _track(self):
-        step = self.model.step
-        t = step * self.model.dt
-        i = int((t - self.start) / self.step)
+        # compare whole model steps, t % step is unreliable for steps like 0.2
+        every = max(1, round(self.step / self.model.dt))
+        first = round(self.start / self.model.dt)
+        step = self.model.step - first
 
-        if (t % self.step == 0.0) and (t >= self.start):  # Save every self.step steps
-            self.u_map[i] = self.model.__dict__["u"]
+        if step >= 0 and step % every == 0:  # Save every self.step time units
+            i = step // every
+            if i >= len(self.u_map):
+                self.n_dropped += 1
+                if self.n_dropped == 1:
+                    warnings.warn(
+                        f"{self.file_name}: frame {i} at t = {self.model.t} does not "
+                        f"fit the {len(self.u_map)} preallocated frames, dropping it"
+                    )
+                return
+            self.u_map[i] = self._frame()
+            self.n_frames = i + 1
+            if self.stream and self.n_frames % self.flush_every == 0:
+                self.flush()
+
+    def _frame(self):
+        """The data stored for the current time step."""
+        u = self.model.__dict__["u"]
+        if self.compact:
+            return np.take(u, self.index)
+        return u
+
+    def flush(self):
+        """Flush the memory-mapped frames and update the progress file."""
+        self.u_map.flush()
+        self._write_progress()
+
+    def _write_progress(self):
+        progress_path = self.file_path.with_suffix(".progress")
+        tmp_path = progress_path.with_suffix(".progress.tmp")
+        tmp_path.write_text(str(self.n_frames))
+        os.replace(tmp_path, progress_path)
 
     def write(self):
-        np.save(
-            Path(self.path).joinpath(self.dir_name).joinpath(self.file_name), self.u_map
-        )
+        if self.n_dropped:
+            warnings.warn(
+                f"{self.file_name}: {self.n_dropped} sampled frames were dropped, "
+                "the voltage map is truncated"
+            )
+        if self.stream:
+            self.flush()
+        else:
+            np.save(self.file_path, self.u_map)
+
+
+class PhaseMapTracker(VoltageMapTracker):
+    """
+    Tracks the phase ``arctan2(u - u_ref, v - v_ref)`` instead of the voltage.
+
+    The phase is computed in-process at every output step and written like
+    the voltage maps of ``VoltageMapTracker`` (optionally streamed and/or
+    compact), with NaN outside the myocardium. This avoids dumping u and v
+    and converting them afterwards.
+
+    Attributes
+    ----------
+    u_ref : float
+        Reference value of u.
+    v_ref : float
+        Reference value of v.
+    trace_cells : list, optional
+        ``(i, j)`` of cells whose u and v are recorded at every output step
+        and saved in ``{file_name}_trace.npz`` as ``(n_frames, n_cells)``
+        arrays, e.g. for a phase-space plot.
+    """
+
+    def __init__(self):
+        VoltageMapTracker.__init__(self)
+        self.file_name = "phase"
+        self.dtype = np.float32
+        self.u_ref = 0.4
+        self.v_ref = 0.1
+        self.trace_cells = None
+
+    def initialize(self, model):
+        VoltageMapTracker.initialize(self, model)
+        self.trace_u = []
+        self.trace_v = []
+
+    def _frame(self):
+        u = self.model.__dict__["u"]
+        v = self.model.__dict__["v"]
+        mesh = self.model.cardiac_tissue.mesh
+
+        if self.trace_cells is not None:
+            rows, cols = np.transpose(self.trace_cells)
+            self.trace_u.append(u[rows, cols])
+            self.trace_v.append(v[rows, cols])
+
+        if self.compact:
+            u, v, mesh = (np.take(x, self.index) for x in (u, v, mesh))
+        phase = np.arctan2(u - self.u_ref, v - self.v_ref)
+        phase[mesh != 1] = np.nan
+        return phase
+
+    def write(self):
+        VoltageMapTracker.write(self)
+        if self.trace_cells is not None:
+            np.savez(
+                self.file_path.with_name(f"{self.file_name}_trace.npz"),
+                cells=self.trace_cells,
+                u=self.trace_u,
+                v=self.trace_v,
+            )
+
+
+class ActivityTracker(Tracker):
+    """
+    Tracks the number of excited cells (``u > threshold``) every ``step`` time
+    units, e.g. to find out whether and when a rotation terminated.
+
+    Attributes
+    ----------
+    threshold : float
+        Voltage above which a cell counts as excited.
+    times : list
+        Sampled times.
+    counts : list
+        Number of excited myocardium cells at those times.
+    """
+
+    def __init__(self):
+        Tracker.__init__(self)
+        self.start = 0
+        self.step = 1
+        self.threshold = 0.1
+
+    def initialize(self, model):
+        self.model = model
+        self.times = []
+        self.counts = []
+
+    def track(self):
+        every = max(1, round(self.step / self.model.dt))
+        step = self.model.step - round(self.start / self.model.dt)
+        if step >= 0 and step % every == 0:
+            u = self.model.__dict__["u"]
+            excited = (u > self.threshold) & (self.model.cardiac_tissue.mesh == 1)
+            self.times.append(self.model.t)
+            self.counts.append(int(np.count_nonzero(excited)))
+
+    @property
+    def t_termination(self):
+        """Time from which no cell was excited anymore, ``None`` if active."""
+        if not self.counts or self.counts[-1] > 0:
+            return None
+        active = np.flatnonzero(self.counts)
+        if len(active) == 0:
+            return self.times[0]
+        return self.times[active[-1] + 1]
+
+    def write(self):
+        pass
+
+
+def open_voltage_map(file_path):
+    """
+    Opens a (possibly still growing) voltage map written by ``VoltageMapTracker``.
+
+    Parameters
+    ----------
+    file_path : str or Path
+        Path of the ``.npy`` file.
+
+    Returns
+    -------
+    np.ndarray
+        Read-only memory map of the frames that have been flushed so far.
+    """
+    file_path = Path(file_path)
+    u_map = np.load(file_path, mmap_mode="r")
+    progress_path = file_path.with_suffix(".progress")
+    if progress_path.exists():
+        u_map = u_map[: int(progress_path.read_text())]
+    return u_map
 
 class ModifiedAlievPanfilov2D(AlievPanfilov2D):
+    """
+    Aliev-Panfilov model with a heterogeneous ``a`` field.
+
+    With ``fused = True`` (default) the diffusion and ionic updates run in a
+    single pass over row runs of myocardium (``spans``), which are rebuilt
+    whenever the weights are recomputed. This avoids decoding flat indexes
+    and a second pass over memory, and gives the same result as the separate
+    diffusion and ionic kernels.
+
+    The precision of the simulation is set with ``npfloat`` (e.g.
+    ``"float32"``). It is carried through the state (u, v), the ``a`` field,
+    the diffusion weights and the scalar parameters, so the kernels are
+    compiled for that precision.
+
+    With ``active_set = True`` only the cells away from rest (|u| or |v|
+    above ``active_tol``) and a halo of ``rebuild_every`` cells around them
+    are updated; all other cells keep their state. The set is rebuilt every
+    ``rebuild_every`` steps, when a stimulus starts and when the weights are
+    recomputed. Activity spreads at most one cell per step through the
+    stencil, so no cell outside the set can be reached by it before the next
+    rebuild. Frozen cells are within ``active_tol`` of the rest state
+    (u = v = 0), a stable fixed point of the model, but the difference to
+    full stepping is not bounded analytically. ``bench_active_set`` in
+    ``benchmarks/run_benchmarks.py`` runs a scenario both ways and checks
+    that the voltage maps agree within ``10 * active_tol``. The active-set
+    mode always uses the fused kernel.
+
+    Attributes
+    ----------
+    fused : bool
+        Use the fused diffusion and ionic kernel.
+    spans : np.ndarray
+        ``(n_spans, 3)`` array of ``(i, j_start, j_stop)`` runs of myocardium.
+    active_set : bool
+        Only update the cells near activity.
+    active_tol : float
+        Distance from rest below which a cell is quiescent.
+    rebuild_every : int
+        Steps between rebuilds of the active set, also the halo width.
+    """
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.fused = True
+        self.spans = np.zeros((0, 3), dtype=np.int64)
+        self.offsets = stencil_offsets(5)
+        self.active_set = False
+        self.active_tol = 1e-4
+        self.rebuild_every = 10
+        self.active_spans = None
+
+    @property
+    def dtype(self):
+        return np.dtype(self.npfloat)
+
+    def initialize(self):
+        super().initialize()
+        self.u = self.u.astype(self.dtype, copy=False)
+        self.u_new = self.u_new.astype(self.dtype, copy=False)
+        self.v = self.v.astype(self.dtype, copy=False)
+        self.a = np.ascontiguousarray(self.a, dtype=self.dtype)
+        self.active_spans = None
+
+    def compute_weights(self):
+        super().compute_weights()
+        self.weights = self.weights.astype(self.dtype, copy=False)
+        self.spans = compute_spans(self.cardiac_tissue.mesh)
+        self.offsets = stencil_offsets(self.weights.shape[-1])
+        self.active_spans = None
+
+    def _stimulus_starts(self):
+        if not self.stim_sequence:
+            return False
+        return any(
+            0 <= self.t - stim.t < self.dt for stim in self.stim_sequence.sequence
+        )
+
+    def update_active_set(self):
+        """
+        Rebuilds the runs of cells that are away from rest or within
+        ``rebuild_every`` cells of such a cell.
+        """
+        myo = self.cardiac_tissue.mesh == 1
+        excited = myo & ((np.abs(self.u) > self.active_tol) |
+                         (np.abs(self.v) > self.active_tol))
+        active = ndimage.maximum_filter(excited, size=2 * self.rebuild_every + 1) & myo
+        # frozen cells keep their current state in both buffers
+        frozen = myo & ~active
+        self.u_new[frozen] = self.u[frozen]
+        self.active_spans = compute_spans(active.astype(int))
+        self.active_fraction = np.count_nonzero(active) / max(1, np.count_nonzero(myo))
+        self._active_step = self.step
+
+    def run_diffusion_kernel(self):
+        # the diffusion is part of the ionic kernel in fused mode
+        if not (self.fused or self.active_set):
+            super().run_diffusion_kernel()
+
     def run_ionic_kernel(self):
         """
         Executes the ionic kernel for the Aliev-Panfilov model.
         """
-        ionic_kernel_2d(self.u_new, self.u, self.v, self.cardiac_tissue.myo_indexes, self.dt, 
-                        self.a, self.k, self.eap, self.mu_1, self.mu_2)
+        # scalars in the model precision, so float32 runs stay in float32
+        dt, k, eap, mu_1, mu_2 = (
+            self.dtype.type(x) for x in (self.dt, self.k, self.eap, self.mu_1, self.mu_2)
+        )
+        if self.active_set:
+            if (self.active_spans is None
+                    or self.step - self._active_step >= self.rebuild_every
+                    or self._stimulus_starts()):
+                self.update_active_set()
+            fused_kernel_2d(self.u_new, self.u, self.v, self.weights, self.offsets,
+                            self.active_spans, dt, self.a, k, eap, mu_1, mu_2)
+            return
+        if self.fused:
+            fused_kernel_2d(self.u_new, self.u, self.v, self.weights, self.offsets,
+                            self.spans, dt, self.a, k, eap, mu_1, mu_2)
+            return
+        ionic_kernel_2d(self.u_new, self.u, self.v, self.cardiac_tissue.myo_indexes, dt, 
+                        self.a, k, eap, mu_1, mu_2)
+
+
+def update_weights_region(model, rows, cols):
+    """
+    Recomputes the weights, ``myo_indexes`` and spans of a model inside a
+    region only, after the mesh changed there.
+
+    The weights of a cell depend on the mesh of its neighbours, so the region
+    has to include a one-cell halo around the changed cells. The stencil is
+    applied to a view of the tissue with two more cells of padding, of which
+    only the region is copied back.
+
+    Parameters
+    ----------
+    model : ModifiedAlievPanfilov2D
+        Initialised model, its mesh already edited.
+    rows, cols : slice
+        Region to update (without negative or ``None`` bounds).
+    """
+    tissue = model.cardiac_tissue
+    ni, nj = tissue.mesh.shape
+    pad = 2
+    r0, r1 = max(rows.start - pad, 0), min(rows.stop + pad, ni)
+    c0, c1 = max(cols.start - pad, 0), min(cols.stop + pad, nj)
+
+    region = copy.copy(tissue)
+    for name, value in vars(tissue).items():
+        if isinstance(value, np.ndarray) and value.shape[:2] == (ni, nj):
+            setattr(region, name, value[r0:r1, c0:c1])
+    weights = model.stencil.compute_weights(model, region)
+    model.weights[rows, cols] = weights[
+        rows.start - r0 : rows.stop - r0, cols.start - c0 : cols.stop - c0
+    ]
+
+    # splice the myocardium of the region into the sorted flat indexes
+    indexes = tissue.myo_indexes
+    pieces = []
+    done = 0
+    for i in range(rows.start, rows.stop):
+        lo, hi = np.searchsorted(indexes, [i * nj + cols.start, i * nj + cols.stop])
+        pieces.append(indexes[done:lo])
+        pieces.append(i * nj + cols.start + np.flatnonzero(tissue.mesh[i, cols] == 1))
+        done = hi
+    pieces.append(indexes[done:])
+    tissue.myo_indexes = np.concatenate(pieces).astype(indexes.dtype)
+
+    if hasattr(model, "spans"):
+        spans = model.spans
+        lo, hi = np.searchsorted(spans[:, 0], [rows.start, rows.stop])
+        region_spans = compute_spans(tissue.mesh[rows])
+        region_spans[:, 0] += rows.start
+        model.spans = np.concatenate([spans[:lo], region_spans, spans[hi:]])
+        model.active_spans = None
+
+
+def compute_spans(mesh):
+    """
+    Row runs of myocardium (``mesh == 1``).
+
+    Parameters
+    ----------
+    mesh : np.ndarray
+        2D tissue mesh.
+
+    Returns
+    -------
+    np.ndarray
+        ``(n_spans, 3)`` array with the row ``i`` and the half-open column
+        range ``[j_start, j_stop)`` of every run, in row-major order.
+    """
+    myo = np.zeros((mesh.shape[0], mesh.shape[1] + 2), dtype=np.int8)
+    myo[:, 1:-1] = mesh == 1
+    edges = np.diff(myo, axis=1)
+    i, j_start = np.nonzero(edges == 1)
+    _, j_stop = np.nonzero(edges == -1)
+    return np.stack([i, j_start, j_stop], axis=1).astype(np.int64)
+
+
+def stencil_offsets(n_weights):
+    """
+    ``(di, dj)`` of the neighbours in the weight order of the 2D stencils.
+
+    Parameters
+    ----------
+    n_weights : int
+        5 for the isotropic stencil, 9 for the (a)symmetric stencil.
+
+    Returns
+    -------
+    np.ndarray
+        ``(n_weights, 2)`` offsets.
+    """
+    if n_weights == 5:
+        offsets = [(-1, 0), (0, -1), (0, 0), (0, 1), (1, 0)]
+    elif n_weights == 9:
+        offsets = [(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)]
+    else:
+        raise ValueError(f"No 2D stencil with {n_weights} weights")
+    return np.array(offsets, dtype=np.int64)
+
+
+@njit(parallel=True)
+def fused_kernel_2d(u_new, u, v, w, offsets, spans, dt, a, k, eap, mu_1, mu_2):
+    """
+    Computes the diffusion and the ionic update of the Aliev-Panfilov 2D
+    model in one pass.
+
+    Parameters
+    ----------
+    u_new : np.ndarray
+        Array to store the updated action potential values.
+    u : np.ndarray
+        Current action potential array.
+    v : np.ndarray
+        Recovery variable array.
+    w : np.ndarray
+        Diffusion weights, ``(ni, nj, n_weights)``.
+    offsets : np.ndarray
+        ``(n_weights, 2)`` neighbour offsets of the weights.
+    spans : np.ndarray
+        ``(n_spans, 3)`` runs ``(i, j_start, j_stop)`` of myocardium.
+    dt : float
+        Time step for the simulation.
+    """
+    n_w = offsets.shape[0]
+
+    for s in prange(spans.shape[0]):
+        i = spans[s, 0]
+        for j in range(spans[s, 1], spans[s, 2]):
+            diffusion = u[i + offsets[0, 0], j + offsets[0, 1]] * w[i, j, 0]
+            for n in range(1, n_w):
+                diffusion += u[i + offsets[n, 0], j + offsets[n, 1]] * w[i, j, n]
+
+            u_ij = u[i, j]
+            v_ij = calc_v(v[i, j], u_ij, dt, a[i, j], k, eap, mu_1, mu_2)
+            v[i, j] = v_ij
+
+            u_new[i, j] = diffusion + dt * (- k * u_ij * (u_ij - a[i, j]) * (u_ij - 1.) -
+                                            u_ij * v_ij)
+
 
 @njit(parallel=True)
 def ionic_kernel_2d(u_new, u, v, indexes, dt, a, k, eap, mu_1, mu_2):
@@ -1,12 +1,22 @@
+import math
+
 import numpy as np
 import scipy as sp
 
 def draw_circle(matrix, center, radius=1, tag=1, invert=False):
+    # distances are only computed inside the bounding box of the circle
     shape = matrix.shape
-    x, y = np.ogrid[:shape[0], :shape[1]]
-    distance_sq = (x - center[0])**2 + (y - center[1])**2 
+    i0 = min(max(math.ceil(center[0] - radius), 0), shape[0])
+    i1 = max(min(math.floor(center[0] + radius) + 1, shape[0]), i0)
+    j0 = min(max(math.ceil(center[1] - radius), 0), shape[1])
+    j1 = max(min(math.floor(center[1] + radius) + 1, shape[1]), j0)
+    x, y = np.ogrid[i0:i1, j0:j1]
+    inside = (x - center[0])**2 + (y - center[1])**2 <= radius**2
+    box = matrix[i0:i1, j0:j1]
     if not invert:
-        matrix[(distance_sq <= radius**2)] = tag
+        box[inside] = tag
     else:
-        matrix[(distance_sq > radius**2)] = tag
+        outside = box.copy()
+        matrix[:] = tag
+        box[inside] = outside[inside]
     return matrix
@@ -0,0 +1,260 @@
+"""Simulates many small square scenarios together, one kernel call per step."""
+
+import numba
+import numpy as np
+from numba import njit, prange
+from tqdm import tqdm
+
+from create_simulations import path, build_scenario
+from custom_fw_classes import calc_v
+
+
+class EnsembleAlievPanfilov2D:
+    """
+    Runs B ``ModifiedAlievPanfilov2D`` models of the same grid size as one
+    ``(B, ni, nj)`` state.
+
+    Every member keeps its own tissue, ``a`` field, conductivity, stimuli,
+    trackers and commands. At initialisation their u, v, a and weights are
+    moved into stacked arrays and the members get views on them, so stimuli,
+    trackers and commands work on the members as usual, while the diffusion
+    and ionic update of all members runs in a single fused kernel call over
+    the myocardium runs of all members.
+
+    When a command recomputes the weights of a member (e.g. ``AdjustScar``),
+    they are copied into the stacked weights and the runs are rebuilt. Region
+    updates (``AdjustScarRegion``) write into the stacked weights directly,
+    only the runs are rebuilt then.
+
+    Every member is stepped over all of its myocardium by the ensemble
+    kernel. The ``fused`` setting of the members has no effect, the separate
+    kernels give the same result. Active-set stepping is not supported,
+    members with ``active_set`` raise a ``ValueError``.
+
+    Attributes
+    ----------
+    members : list
+        The member models. They must share ``dt``, ``t_max``, the grid shape
+        and the stencil.
+    """
+
+    def __init__(self, members):
+        self.members = list(members)
+        self.t = 0
+        self.step = 0
+        self.prog_bar = True
+
+    @property
+    def dt(self):
+        return self.members[0].dt
+
+    @property
+    def t_max(self):
+        return self.members[0].t_max
+
+    def _check_members(self):
+        for member in self.members:
+            if member.active_set:
+                raise ValueError("Members of an ensemble cannot use active-set stepping")
+        first = self.members[0]
+        for member in self.members[1:]:
+            if member.dt != first.dt or member.t_max != first.t_max:
+                raise ValueError("Members of an ensemble must share dt and t_max")
+            if member.u.shape != first.u.shape:
+                raise ValueError("Members of an ensemble must share the grid size")
+            if member.weights.shape != first.weights.shape:
+                raise ValueError("Members of an ensemble must share the stencil")
+            if member.dtype != first.dtype:
+                raise ValueError("Members of an ensemble must share the precision")
+
+    def initialize(self):
+        for member in self.members:
+            member.initialize()
+        self._check_members()
+
+        self.u = np.stack([member.u for member in self.members])
+        self.u_new = np.stack([member.u_new for member in self.members])
+        self.v = np.stack([member.v for member in self.members])
+        self.a = np.stack([member.a for member in self.members])
+        self.weights = np.stack([member.weights for member in self.members])
+        self.offsets = self.members[0].offsets
+        self._bind()
+        self.compute_spans()
+        self.t = 0
+        self.step = 0
+
+    def _bind(self):
+        """Point the member arrays to their slices of the stacked arrays."""
+        for b, member in enumerate(self.members):
+            member.u = self.u[b]
+            member.u_new = self.u_new[b]
+            member.v = self.v[b]
+            member.a = self.a[b]
+            member.weights = self.weights[b]
+
+    def compute_spans(self):
+        """Stack the myocardium runs of the members as ``(b, i, j_start, j_stop)``."""
+        self._member_spans = [member.spans for member in self.members]
+        self.spans = np.concatenate(
+            [
+                np.column_stack([np.full(len(member.spans), b), member.spans])
+                for b, member in enumerate(self.members)
+            ]
+        ).astype(np.int64)
+
+    def _sync_weights(self):
+        """Take over weights that were recomputed by a member."""
+        changed = False
+        for b, member in enumerate(self.members):
+            if member.weights.base is not self.weights:
+                self.weights[b] = member.weights
+                member.weights = self.weights[b]
+                changed = True
+            if member.spans is not self._member_spans[b]:
+                changed = True
+        if changed:
+            self.compute_spans()
+
+    def _load_states(self):
+        for b, member in enumerate(self.members):
+            if member.state_loader:
+                member.state_loader.load()
+                self.u[b] = member.u
+                self.u_new[b] = member.u
+                self.v[b] = member.v
+        self._bind()
+
+    def _parameters(self):
+        dtype = self.members[0].dtype
+        return tuple(
+            np.array([getattr(member, name) for member in self.members], dtype=dtype)
+            for name in ("k", "eap", "mu_1", "mu_2")
+        )
+
+    def run(self, initialize=True, num_of_threads=None):
+        if initialize:
+            self.initialize()
+        if num_of_threads is not None:
+            numba.set_num_threads(min(num_of_threads, numba.config.NUMBA_NUM_THREADS))
+
+        self._load_states()
+        k, eap, mu_1, mu_2 = self._parameters()
+        dt = self.members[0].dtype.type(self.dt)
+
+        iters = int(np.ceil((self.t_max - self.t) / self.dt))
+        for _ in tqdm(range(iters), desc="Running ensemble", disable=not self.prog_bar):
+            for member in self.members:
+                if member.stim_sequence:
+                    member.stim_sequence.stimulate_next()
+
+            ensemble_kernel_2d(self.u_new, self.u, self.v, self.weights, self.offsets,
+                               self.spans, dt, self.a, k, eap, mu_1, mu_2)
+
+            for member in self.members:
+                if member.tracker_sequence:
+                    member.tracker_sequence.tracker_next()
+
+            self.t += self.dt
+            self.step += 1
+            self.u_new, self.u = self.u, self.u_new
+            for member in self.members:
+                member.t = self.t
+                member.step = self.step
+            self._bind()
+
+            for member in self.members:
+                if member.command_sequence:
+                    member.command_sequence.execute_next()
+            self._sync_weights()
+
+
+@njit(parallel=True)
+def ensemble_kernel_2d(u_new, u, v, w, offsets, spans, dt, a, k, eap, mu_1, mu_2):
+    """
+    Computes the diffusion and the ionic update of B stacked Aliev-Panfilov
+    2D models in one pass (see ``fused_kernel_2d``).
+
+    Parameters
+    ----------
+    u_new, u, v, a : np.ndarray
+        ``(B, ni, nj)`` stacked arrays of the members.
+    w : np.ndarray
+        ``(B, ni, nj, n_weights)`` stacked diffusion weights.
+    offsets : np.ndarray
+        ``(n_weights, 2)`` neighbour offsets of the weights.
+    spans : np.ndarray
+        ``(n_spans, 4)`` runs ``(b, i, j_start, j_stop)`` of myocardium.
+    dt : float
+        Time step for the simulation.
+    k, eap, mu_1, mu_2 : np.ndarray
+        ``(B,)`` model parameters of the members.
+    """
+    n_w = offsets.shape[0]
+
+    for s in prange(spans.shape[0]):
+        b = spans[s, 0]
+        i = spans[s, 1]
+        for j in range(spans[s, 2], spans[s, 3]):
+            diffusion = u[b, i + offsets[0, 0], j + offsets[0, 1]] * w[b, i, j, 0]
+            for n in range(1, n_w):
+                diffusion += u[b, i + offsets[n, 0], j + offsets[n, 1]] * w[b, i, j, n]
+
+            u_ij = u[b, i, j]
+            v_ij = calc_v(v[b, i, j], u_ij, dt, a[b, i, j], k[b], eap[b], mu_1[b], mu_2[b])
+            v[b, i, j] = v_ij
+
+            u_new[b, i, j] = diffusion + dt * (- k[b] * u_ij * (u_ij - a[b, i, j]) *
+                                               (u_ij - 1.) - u_ij * v_ij)
+
+
+def run_ensemble(scenarios, path=path, num_of_threads=None):
+    """
+    Builds square scenarios and runs them as one ensemble.
+
+    Parameters
+    ----------
+    scenarios : list
+        Dictionaries with the ``test`` and ``build_scenario`` parameters of
+        every member, optionally with a ``name`` for its output files.
+    path : Path
+        Output directory.
+    num_of_threads : int, optional
+        Numba threads of the ensemble.
+
+    Returns
+    -------
+    list
+        Paths of the scalars and mesh files of every member.
+    """
+    members = []
+    trackers = []
+    for scenario in scenarios:
+        params = dict(scenario)
+        test = params.pop("test")
+        model, umap_tracker, _ = build_scenario(
+            test, path, num_of_threads=num_of_threads, **params
+        )
+        members.append(model)
+        trackers.append(umap_tracker)
+
+    ensemble = EnsembleAlievPanfilov2D(members)
+    ensemble.run(num_of_threads=num_of_threads)
+
+    files = []
+    for model, umap_tracker in zip(members, trackers):
+        for tracker in model.tracker_sequence.sequence:
+            tracker.write()
+        mesh_file = umap_tracker.file_path.with_name(
+            umap_tracker.file_name.replace("scalars", "mesh", 1) + ".npy"
+        )
+        np.save(mesh_file, model.cardiac_tissue.mesh)
+        files.append((umap_tracker.file_path, mesh_file))
+    return files
+
+
+if __name__ == "__main__":
+    # the same scenario for a range of excitability thresholds
+    scenarios = [
+        {"test": 2, "a": a, "name": f"2_a{a}"} for a in [0.11, 0.12, 0.13, 0.14, 0.15]
+    ]
+    run_ensemble(scenarios)
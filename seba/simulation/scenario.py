@@ -0,0 +1,156 @@
+"""Declarative scenario geometry: named layers of shapes, rasterised per shape."""
+
+import hashlib
+import json
+import math
+import os
+from fractions import Fraction
+from pathlib import Path
+
+import numpy as np
+
+from draw_util import draw_circle
+
+SCENARIO_DIR = Path(__file__).parent.parent / "pickle/scenarios"
+
+LAYERS = ["scars", "holes", "temp_scars", "stimuli", "extra_stimuli", "ablation"]
+
+# masks that were already compiled in this process
+_masks = {}
+
+
+def coordinate(value, n):
+    """
+    Grid coordinate of a spec value. A ``Fraction`` is relative to the grid
+    size ``n`` and rounded down (``Fraction(7, 16)`` is ``7 * n // 16``),
+    anything else is absolute.
+    """
+    if isinstance(value, Fraction):
+        return math.floor(value * n)
+    return value
+
+
+def _point(point, shape):
+    return tuple(coordinate(p, n) for p, n in zip(point, shape))
+
+
+def _range(bounds, n):
+    start, stop = bounds
+    start = 0 if start is None else coordinate(start, n)
+    stop = n if stop is None else coordinate(stop, n)
+    return slice(max(start, 0), min(stop, n))
+
+
+def draw_rect(matrix, rows, cols, tag=1):
+    """Set the cells in the half-open ``rows`` x ``cols`` range to ``tag``."""
+    ni, nj = matrix.shape
+    matrix[_range(rows, ni), _range(cols, nj)] = tag
+    return matrix
+
+
+def draw_line(matrix, start, stop, width=1, tag=1):
+    """Set the cells on the segment from ``start`` to ``stop`` (inclusive) to
+    ``tag``, ``width`` cells wide."""
+    ni, nj = matrix.shape
+    (i0, j0), (i1, j1) = start, stop
+    n = int(max(abs(i1 - i0), abs(j1 - j0))) + 1
+    i = np.rint(np.linspace(i0, i1, n)).astype(int)
+    j = np.rint(np.linspace(j0, j1, n)).astype(int)
+    lo = (width - 1) // 2
+    hi = width - lo
+    for di in range(-lo, hi):
+        for dj in range(-lo, hi):
+            ii, jj = i + di, j + dj
+            inside = (ii >= 0) & (ii < ni) & (jj >= 0) & (jj < nj)
+            matrix[ii[inside], jj[inside]] = tag
+    return matrix
+
+
+def draw_diffuse(matrix, density, seed=0, rows=(None, None), cols=(None, None), tag=1):
+    """Set a random fraction ``density`` of the cells in a region to ``tag``
+    (diffuse fibrosis)."""
+    ni, nj = matrix.shape
+    region = matrix[_range(rows, ni), _range(cols, nj)]
+    rng = np.random.default_rng(seed)
+    region[rng.random(region.shape) < density] = tag
+    return matrix
+
+
+def draw_shape(matrix, shape):
+    """Rasterise one shape of a spec into ``matrix``."""
+    kind = shape["shape"]
+    tag = shape.get("tag", 1)
+    size = matrix.shape
+    if kind == "circle":
+        return draw_circle(matrix, _point(shape["center"], size), shape["radius"], tag)
+    if kind == "rect":
+        return draw_rect(matrix, shape["rows"], shape["cols"], tag)
+    if kind == "line":
+        return draw_line(
+            matrix,
+            _point(shape["start"], size),
+            _point(shape["stop"], size),
+            shape.get("width", 1),
+            tag,
+        )
+    if kind == "diffuse":
+        return draw_diffuse(
+            matrix,
+            shape["density"],
+            shape.get("seed", 0),
+            shape.get("rows", (None, None)),
+            shape.get("cols", (None, None)),
+            tag,
+        )
+    raise ValueError(f"Unknown shape: {kind}")
+
+
+def spec_hash(spec, shape):
+    """Hash of a scenario spec on a grid of a given shape."""
+    blob = json.dumps({"spec": spec, "shape": list(shape)}, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def compile_scenario(spec, shape, cache_dir=SCENARIO_DIR):
+    """
+    Masks of all layers of a scenario spec.
+
+    Parameters
+    ----------
+    spec : dict
+        Layer name to a list of shapes. Every shape is a dictionary with a
+        ``shape`` (``"circle"``, ``"rect"``, ``"line"`` or ``"diffuse"``),
+        its geometry and optionally a ``tag`` (default 1), e.g.
+        ``{"shape": "circle", "center": (Fraction(1, 2), 20), "radius": 8}``.
+        Shapes are drawn in order, so later shapes overwrite earlier ones.
+    shape : tuple
+        Grid shape.
+    cache_dir : Path, optional
+        Directory of the on-disk mask cache, ``None`` to only cache in memory.
+
+    Returns
+    -------
+    dict
+        Layer name to an integer matrix for every layer in ``LAYERS`` and in
+        the spec. Layers that are not in the spec are all zero.
+    """
+    key = spec_hash(spec, shape)
+    if key not in _masks:
+        cache_file = None if cache_dir is None else Path(cache_dir) / f"{key}.npz"
+        if cache_file is not None and cache_file.exists():
+            with np.load(cache_file) as data:
+                _masks[key] = dict(data)
+        else:
+            masks = {}
+            for layer in [*LAYERS, *(name for name in spec if name not in LAYERS)]:
+                matrix = np.zeros(shape, dtype=int)
+                for layer_shape in spec.get(layer, []):
+                    draw_shape(matrix, layer_shape)
+                masks[layer] = matrix
+            _masks[key] = masks
+            if cache_file is not None:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                tmp_file = cache_file.with_name(f"{key}.{os.getpid()}.tmp.npz")
+                np.savez_compressed(tmp_file, **masks)
+                os.replace(tmp_file, cache_file)
+    return {layer: matrix.copy() for layer, matrix in _masks[key].items()}
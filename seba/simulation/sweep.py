@@ -0,0 +1,201 @@
+"""Runs square test scenarios over parameter grids in parallel."""
+
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numba
+
+from create_simulations import path, prepaced_state, run_scenario
+
+
+def expand_grid(tests, grid):
+    """
+    All combinations of scenarios and parameter values.
+
+    Parameters
+    ----------
+    tests : list
+        Scenario ids of ``square_setup``.
+    grid : dict
+        Parameter name to list of values, e.g. ``{"scale": [2, 5]}``.
+        Parameters that are left out keep the ``build_scenario`` defaults.
+
+    Returns
+    -------
+    list
+        One dictionary per run with the ``test`` and its parameters.
+    """
+    names = sorted(grid)
+    runs = []
+    for test in tests:
+        for values in itertools.product(*(grid[name] for name in names)):
+            runs.append({"test": test, **dict(zip(names, values))})
+    return runs
+
+
+def run_id(run):
+    """Short, stable identifier of a run."""
+    blob = json.dumps(run, sort_keys=True)
+    return hashlib.sha1(blob.encode()).hexdigest()[:12]
+
+
+def read_manifest(manifest_file):
+    """Finished runs of a sweep, by run id."""
+    finished = {}
+    if Path(manifest_file).exists():
+        with open(manifest_file) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    finished[record["run_id"]] = record
+    return finished
+
+
+def prepace(runs, path=path, num_of_threads=None):
+    """
+    Computes the prepaced states of the runs up front, so parallel runs that
+    share a state do not all compute it at the same time.
+    """
+    keys = ["scale", "cond", "a", "t_start", "dt", "dtype"]
+    configs = {
+        tuple((key, run[key]) for key in keys if key in run)
+        for run in runs
+        if run.get("prepaced", True)
+    }
+    for config in configs:
+        prepaced_state(**dict(config), path=path, num_of_threads=num_of_threads)
+
+
+def split_cores(n_jobs, n_workers=None, threads_per_worker=None):
+    """
+    Worker processes and numba threads per worker for ``n_jobs`` parallel
+    simulations. What is not given is chosen so the cores are divided over
+    the workers and not oversubscribed.
+
+    Returns
+    -------
+    tuple
+        ``n_workers`` and ``threads_per_worker``.
+    """
+    n_cores = os.cpu_count() or 1
+    if n_workers is None:
+        n_workers = max(1, min(n_jobs, n_cores // (threads_per_worker or 4)))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, n_cores // n_workers)
+    threads_per_worker = min(threads_per_worker, numba.config.NUMBA_NUM_THREADS)
+    return n_workers, threads_per_worker
+
+
+def init_worker(threads_per_worker):
+    """Initializer of the worker processes of a ``ProcessPoolExecutor``."""
+    numba.set_num_threads(threads_per_worker)
+
+
+def _run(run, path, threads_per_worker):
+    params = dict(run)
+    test = params.pop("test")
+    start = time.perf_counter()
+    scalars_file, mesh_file = run_scenario(
+        test,
+        path=path,
+        name=f"{test}_{run_id(run)}",
+        num_of_threads=threads_per_worker,
+        **params,
+    )
+    return {
+        "run_id": run_id(run),
+        "run": run,
+        "scalars": str(scalars_file),
+        "mesh": str(mesh_file),
+        "wall_time": time.perf_counter() - start,
+    }
+
+
+def run_sweep(tests, grid, path=path, n_workers=None, threads_per_worker=None):
+    """
+    Runs every combination of scenarios and parameters across a process pool.
+
+    Finished runs are appended to ``path/square/manifest.jsonl`` as soon as
+    they complete. Runs that are already in the manifest are skipped, so an
+    interrupted sweep continues where it stopped. Runs that raise are logged
+    to ``path/square/failed.jsonl`` and do not stop the other runs; they are
+    retried by the next sweep.
+
+    Parameters
+    ----------
+    tests : list
+        Scenario ids of ``square_setup``.
+    grid : dict
+        Parameter grids of ``build_scenario`` (``scale``, ``cond``,
+        ``SC_eps``, ``a``, ``t_stable``, ``t_ablation``, ...).
+    path : Path
+        Output directory.
+    n_workers : int, optional
+        Number of simulations running at the same time.
+    threads_per_worker : int, optional
+        Numba threads per simulation. By default the cores are divided over
+        the workers, so they are not oversubscribed.
+
+    Returns
+    -------
+    list
+        Manifest records of all finished runs of the sweep.
+    """
+    manifest_file = Path(path).joinpath("square/manifest.jsonl")
+    manifest_file.parent.mkdir(parents=True, exist_ok=True)
+    failed_file = manifest_file.with_name("failed.jsonl")
+    finished = read_manifest(manifest_file)
+
+    runs = expand_grid(tests, grid)
+    pending = [run for run in runs if run_id(run) not in finished]
+    print(f"{len(runs) - len(pending)}/{len(runs)} runs already finished")
+    n_workers, threads_per_worker = split_cores(
+        len(pending), n_workers, threads_per_worker
+    )
+    n_cores = os.cpu_count() or 1
+    prepace(pending, path, num_of_threads=min(n_cores, numba.config.NUMBA_NUM_THREADS))
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=init_worker,
+        initargs=(threads_per_worker,),
+    ) as pool:
+        futures = {
+            pool.submit(_run, run, path, threads_per_worker): run for run in pending
+        }
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as e:
+                # not in the manifest, so the run is retried on the next sweep
+                run = futures[future]
+                with open(failed_file, "a") as f:
+                    f.write(json.dumps({"run": run, "error": repr(e)}) + "\n")
+                print(f"failed {run}: {e!r}")
+                continue
+            with open(manifest_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            finished[record["run_id"]] = record
+            print(f"finished {record['run']} in {record['wall_time']:.0f} s")
+
+    n_failed = sum(run_id(run) not in finished for run in runs)
+    if n_failed:
+        print(f"{n_failed}/{len(runs)} runs failed, see {failed_file}")
+    return [finished[run_id(run)] for run in runs if run_id(run) in finished]
+
+
+if __name__ == "__main__":
+    grid = {
+        "scale": [5],
+        "cond": [0.2],
+        "SC_eps": [3, 4, 5],
+        "a": [0.12, 0.15],
+        "t_stable": [28],
+        "t_ablation": [189 - 28],
+    }
+    run_sweep([2, 4, 7], grid, n_workers=4)
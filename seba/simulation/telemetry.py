@@ -0,0 +1,165 @@
+"""Per-phase timing of a running finitewave model."""
+
+import time
+from functools import wraps
+
+import numpy as np
+
+
+class Telemetry:
+    """
+    Times the phases of every simulation step: the diffusion and ionic
+    kernels, the stimuli, every tracker and every command. With the fused
+    kernel (``model.fused`` or ``model.active_set``) diffusion and ionic
+    update are a single phase, ``diffusion+ionic (fused)``.
+
+    ``attach`` wraps the methods of the model and of the objects in its
+    sequences on the instances, so the run loop of finitewave is used
+    unchanged. During the run a line with the cell-updates per second and the
+    share of each phase is printed every ``report_every`` seconds; the rest of
+    the step time (the loop itself, progress bar, buffer swaps) is reported as
+    ``other``. The first step includes the compilation of the kernels, which
+    dominates short runs.
+
+    Attributes
+    ----------
+    model : CardiacModel
+        The timed model.
+    report_every : float, optional
+        Seconds of wall time between reports, ``None`` for no reports.
+    times : dict
+        Accumulated seconds per phase.
+    calls : dict
+        Number of calls per phase.
+    steps : int
+        Number of timed steps.
+    cell_updates : int
+        Number of cell updates of the ionic kernel (only the active set when
+        ``model.active_set`` is on).
+    """
+
+    def __init__(self, model, report_every=30.0):
+        self.model = model
+        self.report_every = report_every
+        self.times = {}
+        self.calls = {}
+        self.steps = 0
+        self.cell_updates = 0
+        self._start = None
+        self._stop = None
+        self._wrapped = []
+
+    def _wrap(self, obj, method, phase):
+        func = getattr(obj, method)
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            if self._start is None:
+                self._start = self._last_report = start
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.times[phase] = self.times.get(phase, 0.0) + elapsed
+                self.calls[phase] = self.calls.get(phase, 0) + 1
+
+        setattr(obj, method, timed)
+        self._wrapped.append((obj, method))
+
+    def attach(self):
+        """Wrap the phases of the model. Call after the model is set up."""
+        model = self.model
+        if getattr(model, "fused", False) or getattr(model, "active_set", False):
+            # the diffusion runs inside the ionic kernel
+            self._wrap(model, "run_ionic_kernel", "diffusion+ionic (fused)")
+        else:
+            self._wrap(model, "run_diffusion_kernel", "diffusion")
+            self._wrap(model, "run_ionic_kernel", "ionic")
+        self._count_steps(model)
+        if model.stim_sequence:
+            self._wrap(model.stim_sequence, "stimulate_next", "stimuli")
+        if model.tracker_sequence:
+            for tracker in model.tracker_sequence.sequence:
+                self._wrap(tracker, "track", type(tracker).__name__)
+        if model.command_sequence:
+            for command in model.command_sequence.sequence:
+                self._wrap(command, "execute", type(command).__name__)
+        return self
+
+    def detach(self):
+        """Restore the original methods and stop the clock."""
+        if self._start is not None:
+            self._stop = time.perf_counter()
+        for obj, method in reversed(self._wrapped):
+            if method in vars(obj):
+                delattr(obj, method)
+        self._wrapped = []
+
+    def _count_steps(self, model):
+        # the ionic kernel runs exactly once per step
+        func = model.run_ionic_kernel
+
+        @wraps(func)
+        def counted(*args, **kwargs):
+            result = func(*args, **kwargs)
+            self.steps += 1
+            self.cell_updates += self._n_cells()
+            now = time.perf_counter()
+            report_every = self.report_every
+            if report_every is not None and now - self._last_report >= report_every:
+                self._last_report = now
+                print(self.format())
+            return result
+
+        model.run_ionic_kernel = counted
+
+    def _n_cells(self):
+        model = self.model
+        spans = model.active_spans if getattr(model, "active_set", False) else None
+        if spans is None:
+            spans = getattr(model, "spans", None)
+        if spans is not None and len(spans):
+            return int(np.sum(spans[:, -1] - spans[:, -2]))
+        return len(model.cardiac_tissue.myo_indexes)
+
+    @property
+    def wall_time(self):
+        if self._start is None:
+            return 0.0
+        stop = self._stop if self._stop is not None else time.perf_counter()
+        return stop - self._start
+
+    def summary(self):
+        """
+        Returns
+        -------
+        dict
+            Steps, wall time, cell-updates per second, and seconds and share
+            of the wall time per phase.
+        """
+        wall_time = self.wall_time
+        phases = dict(self.times)
+        phases["other"] = max(wall_time - sum(phases.values()), 0.0)
+        return {
+            "steps": self.steps,
+            "wall_time": wall_time,
+            "cell_updates_per_s": self.cell_updates / wall_time if wall_time else 0.0,
+            "times": phases,
+            "shares": {
+                phase: seconds / wall_time if wall_time else 0.0
+                for phase, seconds in phases.items()
+            },
+        }
+
+    def format(self):
+        summary = self.summary()
+        shares = ", ".join(
+            f"{phase} {share:.0%}"
+            for phase, share in sorted(summary["shares"].items(), key=lambda x: -x[1])
+        )
+        return (
+            f"t = {self.model.t:.1f}: {summary['steps']} steps in "
+            f"{summary['wall_time']:.1f} s, "
+            f"{summary['cell_updates_per_s'] / 1e6:.1f} M cell updates/s ({shares})"
+        )